@@ -0,0 +1,250 @@
+# /// script
+# requires-python = ">=3.12"
+# dependencies = [
+#     "atproto",
+#     "httpx[http2]",
+#     "monsterui",
+#     "pillow",
+#     "python-fasthtml",
+#     "regex",
+#     "selenium",
+# ]
+# ///
+import argparse
+import atexit
+import base64
+import itertools
+import json
+import os
+import random
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+# Client libraries that should only be imported once a platform actually needs them
+DEFERRED_MODULES = ["atproto", "selenium.webdriver"]
+
+def time_in_fresh_interpreter(code, home):
+    # Each run gets a new interpreter so nothing is already imported or cached in-process
+    env = dict(os.environ, HOME=home, PYTHONPATH=here)
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], env=env, capture_output=True, text=True, check=True)
+    return result.stdout, result.stderr
+
+def startup(args):
+    with tempfile.TemporaryDirectory() as home:
+        code = "import time; t = time.perf_counter(); import social_poster; print(time.perf_counter() - t); import sys; print(','.join(m for m in %r if m in sys.modules))" % DEFERRED_MODULES
+        time_in_fresh_interpreter(code, home)  # first run creates the database and .pyc files
+        runs, loaded = [], ""
+        for _ in range(args.runs):
+            out, _ = time_in_fresh_interpreter(code, home)
+            seconds, loaded = out.split("\n")[-3:-1]
+            runs.append(float(seconds))
+        print(f"import social_poster: median {statistics.median(runs) * 1000:.0f}ms, min {min(runs) * 1000:.0f}ms over {args.runs} runs")
+        print(f"deferred modules loaded at startup: {loaded or 'none'}")
+        for module in DEFERRED_MODULES:
+            _, importtime = time_in_fresh_interpreter(f"import {module}", home)
+            total = int(importtime.strip().splitlines()[-1].split("|")[1])
+            print(f"  {module}: {total / 1000:.0f}ms, paid on first use")
+
+# Local stand-ins for Mastodon, a Bluesky PDS and the Twitter API. Every request waits --latency seconds,
+# then fails with a 500 at --error-rate or a 429 at --rate-limit-rate before answering.
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    ids = itertools.count(1)
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body=None, headers=None):
+        data = json.dumps(body if body is not None else {}).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def handle_request(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        self.body = self.rfile.read(length)
+        config = self.server.config
+        time.sleep(config.latency)
+        roll = random.random()
+        if roll < config.error_rate:
+            return self.reply(500, {"error": "InternalServerError", "message": "mock failure"})
+        if roll < config.error_rate + config.rate_limit_rate:
+            return self.reply(429, {"error": "RateLimitExceeded", "message": "mock rate limit"}, {"Retry-After": str(config.retry_after)})
+        path = self.path.split("?")[0]
+        for pattern, route in self.routes.items():
+            if re.fullmatch(pattern, path) and self.command in route[0].split():
+                return self.reply(200, route[1](self))
+        self.reply(404, {"error": "NotFound"})
+
+    do_GET = do_POST = handle_request
+
+def fake_jwt(did):
+    encode = lambda part: base64.urlsafe_b64encode(json.dumps(part).encode()).rstrip(b"=").decode()
+    return f"{encode({'alg': 'HS256', 'typ': 'JWT'})}.{encode({'sub': did, 'exp': int(time.time()) + 86400})}.c2ln"
+
+def bluesky_session(handler):
+    did = "did:plc:benchmark"
+    return {"did": did, "handle": "bench.test", "accessJwt": fake_jwt(did), "refreshJwt": fake_jwt(did)}
+
+class MockBluesky(MockHandler):
+    routes = {
+        r"/xrpc/com\.atproto\.server\.createSession": ("POST", bluesky_session),
+        r"/xrpc/com\.atproto\.server\.refreshSession": ("POST", bluesky_session),
+        r"/xrpc/com\.atproto\.server\.getSession": ("GET", lambda h: {"did": "did:plc:benchmark", "handle": "bench.test"}),
+        r"/xrpc/app\.bsky\.actor\.getProfile": ("GET", lambda h: {"did": "did:plc:benchmark", "handle": "bench.test"}),
+        r"/xrpc/com\.atproto\.repo\.uploadBlob": ("POST", lambda h: {"blob": {"$type": "blob", "ref": {"$link": "bafkreibme22gw2h7y2h7tg2fhqotaqjucnbc24deqo72b6mkl2egezxhvy"}, "mimeType": h.headers.get("Content-Type", "image/jpeg"), "size": int(h.headers.get("Content-Length") or 0)}}),
+        r"/xrpc/com\.atproto\.repo\.createRecord": ("POST", lambda h: {"uri": f"at://did:plc:benchmark/app.bsky.feed.post/{next(h.ids)}", "cid": "bafyreie5737gdxlw5i64vzichcalba3z2v5n6icifvx5xytvske7mr3hpm"}),
+    }
+
+class MockMastodon(MockHandler):
+    routes = {
+        r"/api/v[12]/media": ("POST", lambda h: {"id": str(next(h.ids)), "type": "image"}),
+        r"/api/v1/media/\d+": ("GET", lambda h: {"id": h.path.rsplit("/", 1)[1], "type": "image"}),
+        r"/api/v1/accounts/verify_credentials": ("GET", lambda h: {"id": "1", "username": "bench"}),
+        r"/api/v1/statuses": ("POST", lambda h: {"id": (status_id := str(next(h.ids))), "url": f"http://localhost/@bench/{status_id}"}),
+    }
+
+def twitter_media(handler):
+    # INIT answers with a new id; APPEND, FINALIZE and STATUS echo the id back as processed
+    media_id = re.search(rb'media_id(?:=|"\r\n\r\n)(\d+)', handler.body + handler.path.encode())
+    if media_id is None:
+        return {"data": {"id": str(next(handler.ids))}}
+    return {"data": {"id": media_id.group(1).decode(), "processing_info": {"state": "succeeded"}}}
+
+class MockTwitter(MockHandler):
+    routes = {
+        r"/2/oauth2/token": ("POST", lambda h: {"access_token": "benchmark", "refresh_token": "benchmark", "expires_in": 7200}),
+        r"/2/users/me": ("GET", lambda h: {"data": {"id": "1", "username": "bench"}}),
+        r"/2/media/upload": ("GET POST", twitter_media),
+        r"/2/tweets": ("POST", lambda h: {"data": {"id": str(next(h.ids)), "text": ""}}),
+    }
+
+def start_mock_server(handler, config):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    server.config = config
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+def report(mode, account_count, media_kb, latencies, failures, elapsed):
+    line = f"{mode:<9} {account_count:>8} {media_kb:>8} {len(latencies):>6} {failures:>6}"
+    if latencies:
+        line += "".join(f" {percentile(latencies, p) * 1000:>8.0f}" for p in (50, 95, 99))
+    else:
+        line += " " + "-" * 26
+    print(f"{line} {len(latencies) / elapsed:>9.1f}", flush=True)
+
+def benchmark_functions(s, targets, uploads, posts):
+    """Call each platform's post function directly, every account posting concurrently"""
+    def timed(account):
+        start = time.perf_counter()
+        try:
+            s.PLATFORMS[account.network].post(account, "Benchmark post https://example.com #bench", uploads)
+            return time.perf_counter() - start, True
+        except Exception:
+            return time.perf_counter() - start, False
+    calls = [account for _ in range(posts) for account in targets]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(targets)) as pool:
+        results = list(pool.map(timed, calls))
+    return [seconds for seconds, ok in results if ok], sum(not ok for _, ok in results), time.perf_counter() - start
+
+def benchmark_route(s, client, targets, media, posts):
+    """Post through /upload and /post, then time each target from enqueue until the outbox finished it"""
+    job_ids = []
+    start = time.perf_counter()
+    for _ in range(posts):
+        if media:
+            client.post("/upload", files=[("files", ("bench.mp4", media, "video/mp4"))])
+        client.post("/post", data={"content": "Benchmark post https://example.com #bench", "account_id": [str(account.id) for account in targets]})
+        job_ids.append(s.outbox_jobs(order_by="id DESC", limit=1)[0].id)
+    while s.outbox_jobs(where=f"id IN ({','.join('?' * len(job_ids))}) AND status NOT IN ('done', 'failed')", where_args=job_ids):
+        time.sleep(0.05)
+    elapsed = time.perf_counter() - start
+    latencies, failures = [], 0
+    for job_id in job_ids:
+        created = datetime.fromisoformat(s.outbox_jobs[job_id].created_at)
+        for target in s.outbox_targets(where="job_id = ?", where_args=[job_id]):
+            if target.status == "posted":
+                latencies.append((datetime.fromisoformat(target.updated_at) - created).total_seconds())
+            else:
+                failures += 1
+    return latencies, failures, elapsed
+
+def throughput(args):
+    # The app keeps its database under ~, so point it at a scratch home before importing it
+    home = tempfile.mkdtemp(prefix="social_poster_bench_")
+    atexit.register(shutil.rmtree, home, True)
+    os.environ["HOME"] = home
+    sys.path.insert(0, here)
+    import social_poster as s
+    from starlette.testclient import TestClient
+
+    _, bluesky_url = start_mock_server(MockBluesky, args)
+    _, mastodon_url = start_mock_server(MockMastodon, args)
+    _, twitter_url = start_mock_server(MockTwitter, args)
+    now = datetime.now().isoformat()
+    accounts = []
+    for i in range(max(args.accounts)):
+        accounts.append(s.accounts.insert(s.Account(network="bluesky", username=f"bench{i}.test", credentials=json.dumps({"handle": f"bench{i}.test", "password": "benchmark", "service": bluesky_url}), created_at=now, updated_at=now)))
+        accounts.append(s.accounts.insert(s.Account(network="mastodon", username=f"bench{i}@127.0.0.1", credentials=json.dumps({"instance": mastodon_url, "access_token": "benchmark"}), created_at=now, updated_at=now)))
+        accounts.append(s.accounts.insert(s.Account(network="twitter", username=f"bench{i}", credentials=json.dumps({"api_base": twitter_url, "access_token": "benchmark", "refresh_token": "benchmark", "expires_at": time.time() + 86400}), created_at=now, updated_at=now)))
+    s.bump_accounts_version()
+
+    print(f"latency {args.latency * 1000:.0f}ms, error rate {args.error_rate:.0%}, 429 rate {args.rate_limit_rate:.0%}; each account count is per network")
+    print(f"{'mode':<9} {'accounts':>8} {'media kB':>8} {'posts':>6} {'failed':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'posts/s':>9}")
+    with TestClient(s.app) as client:
+        for account_count, media_kb in itertools.product(args.accounts, args.media_kb):
+            targets = [account for account in accounts if int(re.search(r"\d+", account.username).group()) < account_count]
+            media = os.urandom(media_kb * 1024) if media_kb else b""
+            if "functions" in args.mode:
+                sha, size = s.store_media(media) if media else (None, 0)
+                uploads = [s.Upload(id=0, filename="bench.mp4", content_type="video/mp4", sha256=sha, size=size, created_at=now)] if media else []
+                benchmark_functions(s, targets, uploads, 1)  # logs in and opens connections
+                s.rate_limits.clear()
+                report("functions", account_count, media_kb, *benchmark_functions(s, targets, uploads, args.posts))
+            if "route" in args.mode:
+                s.rate_limits.clear()
+                report("route", account_count, media_kb, *benchmark_route(s, client, targets, media, args.posts))
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmarks for Social Poster")
+    commands = parser.add_subparsers(dest="command", required=True)
+    startup_parser = commands.add_parser("startup", help="Time importing the app in a fresh interpreter")
+    startup_parser.add_argument("--runs", type=int, default=5)
+    startup_parser.set_defaults(run=startup)
+    comma_ints = lambda value: [int(part) for part in value.split(",")]
+    throughput_parser = commands.add_parser("throughput", help="Post to local mock Bluesky, Mastodon and Twitter API servers and report latency percentiles")
+    throughput_parser.add_argument("--mode", choices=["functions", "route", "functions,route"], default="functions,route", help="Call the post functions directly, go through /post and the outbox, or both")
+    throughput_parser.add_argument("--accounts", type=comma_ints, default=[1, 4, 16], help="Comma separated accounts per network")
+    throughput_parser.add_argument("--media-kb", type=comma_ints, default=[0, 512], help="Comma separated attachment sizes in kB, 0 for none")
+    throughput_parser.add_argument("--posts", type=int, default=10, help="Posts per account for each combination")
+    throughput_parser.add_argument("--latency", type=float, default=0.05, help="Seconds the mock servers wait before answering")
+    throughput_parser.add_argument("--error-rate", type=float, default=0, help="Fraction of requests answered with a 500")
+    throughput_parser.add_argument("--rate-limit-rate", type=float, default=0, help="Fraction of requests answered with a 429")
+    throughput_parser.add_argument("--retry-after", type=float, default=0.5, help="Retry-After seconds sent with mock 429s")
+    throughput_parser.set_defaults(run=throughput)
+    args = parser.parse_args(argv)
+    args.run(args)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -2,9 +2,12 @@
 # requires-python = ">=3.12"
 # dependencies = [
 #     "atproto",
+#     "httpx[http2]",
 #     "monsterui",
+#     "pillow",
 #     "python-fasthtml",
-#     "requests",
+#     "python-multipart",
+#     "regex",
 #     "selenium",
 # ]
 # ///
@@ -15,17 +18,41 @@ from monsterui.all import *
 import os
 import json
 import time
-from datetime import datetime
-from atproto import Client as AtprotoClient, models
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-import requests
+from datetime import datetime, timedelta
+from contextlib import contextmanager
+import httpx
+import importlib.util
 import re
+import regex as unicode_regex
+import unicodedata
+import functools
+import itertools
+import argparse
+import csv
+import sys
+import hashlib
+import base64
+import secrets
+import mimetypes
+import random
+import uuid
+import threading
+import heapq
+import bisect
+import statistics
+import atexit
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future, wait, FIRST_COMPLETED
+import multiprocessing
+from concurrent.futures.process import BrokenProcessPool
+import dataclasses
+import io
+import asyncio
+import subprocess
+from python_multipart.multipart import MultipartParser, MultipartParseError, parse_options_header
 
-# Setup FastHTML app with MonsterUI's blue theme and DaisyUI
-app, rt = fast_app(hdrs=Theme.blue.headers(daisy=True))
+# Setup FastHTML app with MonsterUI's blue theme and DaisyUI, plus the htmx SSE extension for post results
+app, rt = fast_app(hdrs=(*Theme.blue.headers(daisy=True), Script(src="https://cdn.jsdelivr.net/npm/htmx-ext-sse@2.2.2/sse.js")))
 
 db_dir = os.path.join(os.path.expanduser("~"), ".social_poster")
 print(db_dir)
@@ -41,34 +68,202 @@ class Account:
     credentials: str = None
     created_at: str = None
     updated_at: str = None
-accounts = db.create(Account, pk="id")
+    session: str = None
+accounts = db.create(Account, pk="id", transform=True)
+
+# Account registry: accounts and groups are read from the database once, with their
+# credentials parsed, and re-read only after a login, logout, session change or group
+# change bumps the version
+accounts_version = 0
+account_registry = None  # (version, {id: Account}, {id: credentials}, {group id: (AccountGroup, [account ids])})
+account_registry_lock = threading.Lock()
+
+def bump_accounts_version():
+    global accounts_version
+    with account_registry_lock:
+        accounts_version += 1
+
+def load_account_registry():
+    global account_registry
+    with account_registry_lock:
+        if account_registry is None or account_registry[0] != accounts_version:
+            loaded = list(accounts())
+            groups = {group.id: (group, []) for group in account_groups(order_by="name")}
+            for member in group_members(order_by="rowid"):
+                if member.group_id in groups:
+                    groups[member.group_id][1].append(member.account_id)
+            account_registry = (
+                accounts_version,
+                {account.id: account for account in loaded},
+                {account.id: json.loads(account.credentials or "{}") for account in loaded},
+                groups,
+            )
+        return account_registry
+
+def get_accounts():
+    return list(load_account_registry()[1].values())
+
+def get_account(id):
+    return load_account_registry()[1].get(id)
+
+def account_credentials(account):
+    credentials = load_account_registry()[2].get(account.id)
+    return credentials if credentials is not None else json.loads(account.credentials)
+
+def save_account(network, username, credentials, session=None):
+    """Connect an account, or refresh the credentials of one that is already connected"""
+    now = datetime.now().isoformat()
+    existing = next((account for account in get_accounts() if account.network == network and account.username == username), None)
+    if existing:
+        account = accounts.update({"id": existing.id, "credentials": json.dumps(credentials), "session": session, "updated_at": now})
+    else:
+        account = accounts.insert(Account(network=network, username=username, credentials=json.dumps(credentials), session=session, created_at=now, updated_at=now))
+    bump_accounts_version()
+    return account
+
+# Account groups: named sets of accounts that can be posted to in one go
+@dataclass
+class AccountGroup:
+    id: int = None
+    name: str = None
+    created_at: str = None
+account_groups = db.create(AccountGroup, pk="id")
+
+@dataclass
+class GroupMember:
+    group_id: int = None
+    account_id: int = None
+group_members = db.create(GroupMember, pk=("group_id", "account_id"))
+
+def get_groups():
+    return [group for group, _ in load_account_registry()[3].values()]
+
+def group_accounts(group_id):
+    registry = load_account_registry()
+    members = set(registry[3][group_id][1]) if group_id in registry[3] else set()
+    return [account for account in registry[1].values() if account.id in members]
+
+def selected_accounts(account_ids=None, group_ids=None):
+    """Accounts picked directly or through groups, each once, in the order they were picked"""
+    selected = {}
+    for id in account_ids or []:
+        if str(id).isdigit() and (account := get_account(int(id))):
+            selected[account.id] = account
+    for id in group_ids or []:
+        if str(id).isdigit():
+            selected.update((account.id, account) for account in group_accounts(int(id)))
+    return list(selected.values())
 
 @dataclass
 class Upload:
     id: int = None
     filename: str = None
     content_type: str = None
-    data: bytes = None
+    sha256: str = None
+    size: int = None
     created_at: str = None
-uploads = db.create(Upload, pk="id")
+uploads = db.create(Upload, pk="id", transform=True)
+# Uploads from before the media store kept their bytes in the table and can't be recovered
+db.execute("DELETE FROM upload WHERE sha256 IS NULL")
+
+# Media store: file contents live on disk under their SHA-256 so identical files are
+# stored once, and the upload table only holds metadata
+media_dir = os.path.join(db_dir, "media")
+os.makedirs(media_dir, exist_ok=True)
+
+def media_path(sha256):
+    return os.path.join(media_dir, sha256[:2], sha256)
+
+def commit_media(temp_path, sha256):
+    """Move a fully written temporary file into the store, or drop it if the content is already there"""
+    path = media_path(sha256)
+    if os.path.exists(path):
+        os.remove(temp_path)
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(temp_path, path)
+    return sha256
+
+def store_media(data):
+    with tempfile.NamedTemporaryFile(dir=media_dir, suffix=".tmp", delete=False) as f:
+        f.write(data)
+    return commit_media(f.name, hashlib.sha256(data).hexdigest()), len(data)
+
+def open_media(upload):
+    return open(media_path(upload.sha256), "rb")
+
+# Platform-ready versions of stored media, keyed by the original's hash and the
+# network profile they were prepared for (see prepare_media)
+@dataclass
+class MediaVariant:
+    source_sha256: str = None
+    profile: str = None
+    sha256: str = None
+    size: int = None
+    content_type: str = None
+media_variants = db.create(MediaVariant, pk=["source_sha256", "profile"])
+
+def media_in_use(sha256):
+    if db.q("SELECT 1 FROM upload WHERE sha256 = ? LIMIT 1", [sha256]):
+        return True
+    # Media attached to outbox jobs that haven't finished yet, or that can still be retried
+    return bool(db.q("""SELECT 1 FROM outbox_job, json_each(outbox_job.media) AS m
+                       WHERE outbox_job.status IN ('scheduled', 'pending', 'running', 'failed') AND json_extract(m.value, '$.sha256') = ? LIMIT 1""", [sha256]))
+
+def remove_media_file(sha256):
+    try:
+        os.remove(media_path(sha256))
+    except FileNotFoundError:
+        pass
+
+def release_media(sha256s):
+    """Delete stored files, and the variants prepared from them, that nothing references any more"""
+    for sha256 in set(sha256s):
+        if media_in_use(sha256):
+            continue
+        remove_media_file(sha256)
+        remove_thumbnail(sha256)
+        for variant in media_variants(where="source_sha256 = ?", where_args=[sha256]):
+            media_variants.delete((variant.source_sha256, variant.profile))
+            if variant.sha256 != sha256:
+                remove_media_file(variant.sha256)
+
+def link_media(upload, path):
+    """Expose a stored file under another path, copying only if hard links aren't possible"""
+    try:
+        os.link(media_path(upload.sha256), path)
+    except OSError:
+        shutil.copyfile(media_path(upload.sha256), path)
 
 # Mastodon OAuth configuration
 MASTODON_REDIRECT_URI = "http://localhost:5001/login/mastodon/callback"
 
+# Twitter API (OAuth 2.0 with PKCE) configuration. Accounts can connect through the API
+# once TWITTER_CLIENT_ID is set, and TWITTER_CLIENT_SECRET too for a confidential client.
+# TWITTER_API_BASE and TWITTER_AUTHORIZE_URL can point at a local stand-in server.
+TWITTER_REDIRECT_URI = "http://localhost:5001/login/twitter/callback"
+TWITTER_CLIENT_ID = os.environ.get("TWITTER_CLIENT_ID")
+TWITTER_CLIENT_SECRET = os.environ.get("TWITTER_CLIENT_SECRET")
+TWITTER_API_BASE = os.environ.get("TWITTER_API_BASE", "https://api.x.com")
+TWITTER_AUTHORIZE_URL = os.environ.get("TWITTER_AUTHORIZE_URL", "https://x.com/i/oauth2/authorize")
+TWITTER_SCOPES = "tweet.read tweet.write users.read media.write offline.access"
+
 # Main route
 @rt("/")
 def get():
-    active_accounts = list(accounts())
+    active_accounts = get_accounts()
     has_accounts = bool(active_accounts)
     tabs = TabContainer(
         Li(A("Accounts"), cls='uk-active' if not has_accounts else ''),
         Li(A("Post"), cls='uk-active' if has_accounts else ''),
+        Li(A("Metrics")),
         uk_switcher='connect: #tab-content; animation: uk-animation-fade',
         alt=True
     )
     content = Ul(id="tab-content", cls="uk-switcher")(
         Li(render_accounts_tab(active_accounts)),
-        Li(render_post_tab(active_accounts))
+        Li(render_post_tab(active_accounts)),
+        Li(render_metrics_tab())
     )
     return (
         Title("Open Social Poster"),
@@ -84,6 +279,7 @@ def get():
 def render_accounts_tab(active_accounts):
     return Div(
         render_connected_accounts(active_accounts),
+        render_account_groups(active_accounts),
         H2("Connect a New Account"),
         render_connection_forms(),
         id="accounts-content"
@@ -136,15 +332,16 @@ def render_post_tab(active_accounts):
             id="post-content"
         )
 
-def render_uploaded_files():
+def render_uploaded_files(error=None):
     current_uploads = list(uploads())
+    error_alert = Alert(error, cls=AlertT.error) if error else ""
     if not current_uploads:
-        return Div(id="uploaded-files")
+        return Div(error_alert, id="uploaded-files")
     
     file_items = [
         Div(
             DivLAligned(
-                get_file_icon(upload.filename),
+                render_thumbnail(upload),
                 P(truncate_filename(upload.filename), cls="ml-1 text-sm"),
                 Button(
                     UkIcon('x', cls="h-4 w-4 text-red-500"),
@@ -166,6 +363,7 @@ def render_uploaded_files():
             ),
             Div(cls="flex flex-wrap")(*file_items),
         ),
+        error_alert,
         id="uploaded-files",
     )
 
@@ -193,22 +391,157 @@ def get_file_icon(filename):
     
     return UkIcon(icon_name, cls="text-gray-500")
 
-# File upload route
-@rt("/upload")
-async def post(files: list[UploadFile]):
-    for file in files:
-        uploads.insert(Upload(
-            filename=file.filename,
-            content_type=file.content_type,
-            data=await file.read(),
+# Upload limits: files are streamed into the media store in chunks, so memory use
+# stays flat however large they are, and anything over a cap is rejected early
+MAX_UPLOAD_SIZE = 512 * 1024 * 1024
+MAX_DRAFT_SIZE = 1024 * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+MULTIPART_OVERHEAD = 64 * 1024
+ALLOWED_MEDIA_TYPES = ("image/", "video/", "audio/")
+
+class UploadRejected(Exception):
+    pass
+
+def upload_content_type(filename, content_type):
+    if not content_type or content_type == "application/octet-stream":
+        content_type = mimetypes.guess_type(filename)[0] or content_type
+    if not content_type or not content_type.startswith(ALLOWED_MEDIA_TYPES):
+        raise UploadRejected(f"{filename}: unsupported file type ({content_type or 'unknown'})")
+    return content_type
+
+def draft_size():
+    return db.q("SELECT COALESCE(SUM(size), 0) AS total FROM upload")[0]["total"]
+
+class UploadPart:
+    """A file part of an upload, hashed as it is written to a temporary file in the media store"""
+    def __init__(self, filename, content_type, limit):
+        self.filename, self.content_type, self.limit = filename, content_type, limit
+        self.digest = hashlib.sha256()
+        self.size = 0
+        self.file = tempfile.NamedTemporaryFile(dir=media_dir, suffix=".tmp", delete=False)
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self.limit:
+            raise UploadRejected(f"{self.filename}: too large")
+        self.digest.update(data)
+        self.file.write(data)
+
+    def commit(self):
+        self.file.close()
+        return commit_media(self.file.name, self.digest.hexdigest())
+
+    def discard(self):
+        self.file.close()
+        os.remove(self.file.name)
+
+async def ingest_uploads(req, remaining):
+    """Parse a multipart body as it arrives, streaming each file part straight into the media
+    store, and add the files to the draft. Returns why any part was rejected"""
+    content_type, options = parse_options_header(req.headers.get("content-type"))
+    if content_type != b"multipart/form-data" or not options.get(b"boundary"):
+        return ["Uploads must be sent as multipart/form-data"]
+    errors = []
+    headers, field, value = {}, b"", b""
+    part = None
+
+    def on_part_begin():
+        headers.clear()
+
+    def on_header_field(data, start, end):
+        nonlocal field
+        field += data[start:end]
+
+    def on_header_value(data, start, end):
+        nonlocal value
+        value += data[start:end]
+
+    def on_header_end():
+        nonlocal field, value
+        headers[field.lower()] = value
+        field, value = b"", b""
+
+    def on_headers_finished():
+        nonlocal part
+        _, disposition = parse_options_header(headers.get(b"content-disposition", b""))
+        filename = disposition.get(b"filename", b"").decode(errors="replace")
+        if disposition.get(b"name") != b"files" or not filename:
+            return
+        try:
+            content_type = upload_content_type(filename, headers.get(b"content-type", b"").decode("latin-1"))
+        except UploadRejected as e:
+            errors.append(str(e))
+            return
+        part = UploadPart(filename, content_type, min(MAX_UPLOAD_SIZE, remaining))
+
+    def on_part_data(data, start, end):
+        nonlocal part
+        if part is None:
+            return
+        try:
+            part.write(data[start:end])
+        except UploadRejected as e:
+            # The rest of the part is skipped rather than written
+            errors.append(str(e))
+            part.discard()
+            part = None
+
+    def on_part_end():
+        nonlocal part, remaining
+        if part is None:
+            return
+        sha256 = part.commit()
+        remaining -= part.size
+        warm_media_variants(uploads.insert(Upload(
+            filename=part.filename,
+            content_type=part.content_type,
+            sha256=sha256,
+            size=part.size,
             created_at=datetime.now().isoformat()
-        ))
-    return render_uploaded_files()
+        )))
+        part = None
+
+    parser = MultipartParser(options[b"boundary"], {
+        "on_part_begin": on_part_begin,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data,
+        "on_part_end": on_part_end,
+    })
+    try:
+        async for chunk in req.stream():
+            parser.write(chunk)
+        parser.finalize()
+    except MultipartParseError:
+        errors.append("The upload was malformed")
+    finally:
+        if part is not None:
+            part.discard()
+    return errors
+
+# File upload route. It is a plain Starlette route because FastHTML reads the whole
+# form before calling a handler, and here the body is parsed as it streams in
+async def upload(req):
+    # Without a length the body can't be checked against the caps before it is read
+    if "content-length" not in req.headers:
+        return Response("Uploads need a Content-Length", status_code=411)
+    remaining = MAX_DRAFT_SIZE - draft_size()
+    # Refuse a request that can't fit before its body is read at all
+    if int(req.headers["content-length"]) > remaining + MULTIPART_OVERHEAD:
+        return HTMLResponse(to_xml(render_uploaded_files(f"Attachments are limited to {MAX_DRAFT_SIZE // (1024 * 1024)} MB per post.")))
+    errors = await ingest_uploads(req, remaining)
+    return HTMLResponse(to_xml(render_uploaded_files("; ".join(errors) if errors else None)))
+
+app.add_route(Route("/upload", upload, methods=["POST"]))
 
 # Delete upload route
 @rt("/delete_upload/{id}")
 def delete(id: int):
+    upload = uploads[id]
     uploads.delete(id)
+    release_media([upload.sha256])
     return render_uploaded_files()
 
 # Connected accounts rendering (unchanged)
@@ -218,6 +551,7 @@ def render_connected_accounts(active_accounts):
     account_divs = [
         Card(
             CardHeader(DivLAligned(UkIcon(account.network), H3(f"{account.network.capitalize()}: {account.username}"))),
+            CardBody(render_account_health(account.id)),
             CardFooter(
                 Button(UkIcon('log-out'), "Logout", hx_post=f"/logout/{account.id}", hx_target="#accounts-content", hx_swap="outerHTML", cls=ButtonT.secondary)
             ),
@@ -226,68 +560,120 @@ def render_connected_accounts(active_accounts):
     ]
     return (H2("Your Connected Accounts"), Grid(*account_divs, cols=1))
 
-# Connection forms (unchanged)
+def render_account_health(account_id):
+    health = account_health.get(account_id)
+    if health is None:
+        # Still being checked, so ask again shortly
+        return P("Checking connection...", cls=(TextT.sm, TextT.muted), hx_get=f"/accounts/{account_id}/health", hx_trigger="every 2s", hx_swap="outerHTML")
+    ok, message = health
+    return DivLAligned(UkIcon("check" if ok else "triangle-alert"), P(message, cls=TextT.sm), cls=TextT.success if ok else TextT.error)
+
+@rt("/accounts/{id}/health")
+def get(id: int):
+    if id not in account_health and (account := get_account(id)):
+        warm_up([account])
+    return render_account_health(id)
+
+def render_account_groups(active_accounts):
+    if len(active_accounts) < 2:
+        return ""
+    group_cards = [
+        Card(
+            CardHeader(H4(group.name)),
+            CardBody(P(", ".join(f"{account.network.capitalize()}: {account.username}" for account in group_accounts(group.id)) or "No accounts", cls=TextT.sm)),
+            CardFooter(Button(UkIcon('trash'), "Delete", hx_post=f"/groups/{group.id}/delete", hx_target="#accounts-content", hx_swap="outerHTML", cls=ButtonT.secondary)),
+        ) for group in get_groups()
+    ]
+    new_group = Form(
+        FormLabel("Group name"),
+        Input(name="name", placeholder="e.g. Brand accounts", cls="w-full"),
+        Group(*[LabelCheckboxX(id=f"group_account_{account.id}", name="account_id", value=str(account.id), label=f"{account.network.capitalize()}: {account.username}") for account in active_accounts], cls="flex flex-wrap gap-4"),
+        Button("Create group", type="submit", cls=ButtonT.primary),
+        hx_post="/groups",
+        hx_target="#accounts-content",
+        hx_swap="outerHTML",
+        cls="space-y-2"
+    )
+    return Div(H2("Account Groups"), Grid(*group_cards, cols=1) if group_cards else "", Card(CardBody(new_group)), cls="space-y-4")
+
+@rt("/groups")
+def post(name: str, account_id: list[str] = None):
+    if not name.strip() or not account_id:
+        return render_updated_accounts_tab_with_error("Give the group a name and pick at least one account.")
+    group = account_groups.insert(AccountGroup(name=name.strip(), created_at=datetime.now().isoformat()))
+    for account in selected_accounts(account_id):
+        group_members.insert(GroupMember(group_id=group.id, account_id=account.id))
+    bump_accounts_version()
+    return render_updated_accounts_tab()
+
+@rt("/groups/{id}/delete")
+def post(id: int):
+    db.execute("DELETE FROM group_member WHERE group_id = ?", [id])
+    account_groups.delete(id)
+    bump_accounts_version()
+    return render_updated_accounts_tab()
+
+# Connection forms: one card per platform. Any number of accounts can be connected per network.
 def render_connection_forms():
-    active_accounts = list(accounts())
-    connected_networks = [account.network for account in active_accounts]
-    connection_cards = []
-    # Bluesky connection
-    if "bluesky" not in connected_networks:
-        connection_cards.append(
-            Card(
-                CardHeader(DivLAligned(UkIcon('bluesky'), H3("Bluesky"))),
-                CardBody(
-                    P("Connect using your handle and an app password."),
-                    P(A("Create an App Password", href="https://bsky.app/settings/app-passwords", target="_blank"), " before logging in."),
-                    Form(
-                        FormLabel("Handle"),
-                        Input(id="bsky-handle", name="handle", placeholder="Your Bluesky handle", cls="w-full"),
-                        FormLabel("App Password"),
-                        Input(id="bsky-password", name="password", type="password", placeholder="App Password", cls="w-full"),
-                        Button("Connect", type="submit", cls=ButtonT.primary),
-                        hx_post="/login/bluesky",
-                        hx_target="#accounts-content",
-                        hx_swap="outerHTML",
-                        cls="space-y-2"
-                    )
-                ),
-                cls=CardT.default
-            )
-        )
-    # Twitter connection
-    if "twitter" not in connected_networks:
-        connection_cards.append(
-            Card(
-                CardHeader(DivLAligned(UkIcon('twitter'), H3("Twitter/X"))),
-                CardBody(
-                    P("Connect using browser login."),
-                    P("This will open a browser window. Please login and then wait for the browser to close."),
-                    Button("Connect with Twitter", hx_post="/login/twitter", hx_target="#accounts-content", hx_swap="outerHTML", cls=ButtonT.primary)
-                ),
-                cls=CardT.default
-            )
-        )
-    # Mastodon connection
-    if "mastodon" not in connected_networks:
-        connection_cards.append(
-            Card(
-                CardHeader(DivLAligned(UkIcon('mastodon'), H3("Mastodon"))),
-                CardBody(
-                    P("Connect to your Mastodon instance."),
-                    Form(
-                        FormLabel("Instance"),
-                        Input(id="mastodon-instance", name="instance", placeholder="yourdomain.social", cls="w-full"),
-                        Button("Connect", type="submit", cls=ButtonT.primary),
-                        action="/login/mastodon",
-                        method="post",
-                        cls="space-y-2"
-                    ),
-                    P("Enter your instance domain without https://", cls="text-muted")
-                ),
-                cls=CardT.default
+    return Grid(*[platform.connect_card() for platform in PLATFORMS.values()], cols=1)
+
+def bluesky_connect_card():
+    return Card(
+        CardHeader(DivLAligned(UkIcon('bluesky'), H3("Bluesky"))),
+        CardBody(
+            P("Connect using your handle and an app password."),
+            P(A("Create an App Password", href="https://bsky.app/settings/app-passwords", target="_blank"), " before logging in."),
+            Form(
+                FormLabel("Handle"),
+                Input(id="bsky-handle", name="handle", placeholder="Your Bluesky handle", cls="w-full"),
+                FormLabel("App Password"),
+                Input(id="bsky-password", name="password", type="password", placeholder="App Password", cls="w-full"),
+                Button("Connect", type="submit", cls=ButtonT.primary),
+                hx_post="/login/bluesky",
+                hx_target="#accounts-content",
+                hx_swap="outerHTML",
+                cls="space-y-2"
             )
-        )
-    return Grid(*connection_cards, cols=1) if connection_cards else P("You're connected to all available networks.", cls="text-muted")
+        ),
+        cls=CardT.default
+    )
+
+def twitter_connect_card():
+    api_login = Form(
+        P("Or connect through the X API, which posts without a browser."),
+        Button("Connect with the X API", type="submit", cls=ButtonT.secondary),
+        action="/login/twitter/api",
+        method="post",
+        cls="space-y-2"
+    ) if TWITTER_CLIENT_ID else ""
+    return Card(
+        CardHeader(DivLAligned(UkIcon('twitter'), H3("Twitter/X"))),
+        CardBody(
+            P("Connect using browser login."),
+            P("This will open a browser window. Please login and then wait for the browser to close."),
+            Button("Connect with Twitter", hx_post="/login/twitter", hx_target="#accounts-content", hx_swap="outerHTML", cls=ButtonT.primary),
+            api_login
+        ),
+        cls=CardT.default
+    )
+
+def mastodon_connect_card():
+    return Card(
+        CardHeader(DivLAligned(UkIcon('mastodon'), H3("Mastodon"))),
+        CardBody(
+            P("Connect to your Mastodon instance."),
+            Form(
+                FormLabel("Instance"),
+                Input(id="mastodon-instance", name="instance", placeholder="yourdomain.social", cls="w-full"),
+                Button("Connect", type="submit", cls=ButtonT.primary),
+                action="/login/mastodon",
+                method="post",
+                cls="space-y-2"
+            ),
+            P("Enter your instance domain without https://", cls="text-muted")
+        ),
+        cls=CardT.default
+    )
 
 # Post form rendering (unchanged)
 def render_post_form(active_accounts):
@@ -300,8 +686,21 @@ def render_post_form(active_accounts):
             label=f"{account.network.capitalize()}: {account.username}"
         ) for account in active_accounts
     ]
+    group_checkboxes = [
+        LabelCheckboxX(
+            id=f"group_{group.id}",
+            name="group_id",
+            value=str(group.id),
+            label=f"{group.name} ({len(group_accounts(group.id))})"
+        ) for group in get_groups()
+    ]
     loading = Loading(cls=LoadingT.spinner, htmx_indicator=True, id="post-loading")
     form = Form(
+        Div(
+            P("Post to groups:", cls="text-white mb-2"),
+            Group(*group_checkboxes, cls="flex flex-wrap gap-4"),
+            cls="mb-4"
+        ) if group_checkboxes else "",
         Div(
             P("Select accounts to post to:", cls="text-white mb-2"),
             Group(*account_checkboxes, cls="flex flex-wrap gap-4"),
@@ -316,9 +715,12 @@ def render_post_form(active_accounts):
             cls="w-full p-4 border border-gray-500 rounded-lg bg-gray-700 text-white placeholder-gray-300 focus:outline-none focus:ring-2 focus:ring-blue-400",
             hx_trigger="keyup changed delay:500ms",
             hx_get="/check_length",
+            hx_include="closest form",
             hx_target="#char-warning"
         ),
         Div(id="char-warning", cls="text-sm text-red-500 mt-2"),
+        FormLabel("Schedule for (optional)", fr="scheduled-at", cls="text-white"),
+        Input(id="scheduled-at", name="scheduled_at", type="datetime-local", cls="w-full"),
         Div(loading, cls="mt-2"),
         Button(
             UkIcon('send', cls="mr-2"),
@@ -327,6 +729,7 @@ def render_post_form(active_accounts):
             cls="mt-4 bg-blue-600 text-white px-4 py-2 rounded-md hover:bg-blue-500 transition-colors"
         ),
         Div(id="post-result", cls="mt-4"),
+        render_idempotency_key(),
         hx_post="/post",
         hx_target="#post-result",
         hx_swap="innerHTML",
@@ -334,44 +737,113 @@ def render_post_form(active_accounts):
         hx_disabled_elt="find button",
         cls="space-y-4"
     )
-    return Card(CardBody(form), cls="bg-gray-800 border border-gray-700 rounded-lg shadow-md")
+    return Card(CardBody(form, render_scheduled_posts()), cls="bg-gray-800 border border-gray-700 rounded-lg shadow-md")
+
+def render_idempotency_key(**kwargs):
+    return Input(type="hidden", name="idempotency_key", value=uuid.uuid4().hex, id="idempotency-key", **kwargs)
+
+def render_scheduled_posts(**kwargs):
+    upcoming = outbox_jobs(where="status = 'scheduled'", order_by="scheduled_at, id", limit=20)
+    if not upcoming:
+        return Div(id="scheduled-posts", **kwargs)
+    items = [
+        DivLAligned(
+            UkIcon('clock', cls="mr-2"),
+            P(f"{datetime.fromisoformat(job.scheduled_at):%Y-%m-%d %H:%M}: {truncate_filename(job.content, 40)}", cls="text-sm text-white"),
+            Button(UkIcon('x', cls="h-4 w-4 text-red-500"), hx_post=f"/scheduled/{job.id}/cancel", hx_target="#scheduled-posts", hx_swap="outerHTML", cls="ml-2 p-0"),
+            cls="py-1"
+        ) for job in upcoming
+    ]
+    return Div(H4("Scheduled Posts", cls="text-white mt-4"), *items, id="scheduled-posts", **kwargs)
+
+@rt("/scheduled/{id}/cancel")
+def post(id: int):
+    cancel_scheduled_job(id)
+    return render_scheduled_posts()
+
+# Post length as each network counts it:
+# - Twitter weights code points (1 for Latin and common punctuation, 2 otherwise), counts
+#   each emoji as 2 and every URL as 23
+# - Mastodon counts grapheme clusters, every URL as 23 and @user@domain mentions as @user
+# - Bluesky counts grapheme clusters
+# Lengths are cached per line, so a keystroke only recounts the line being edited.
+URL_LENGTH = 23
+URL_PATTERN = re.compile(r'https?://[^\s]+')
+MASTODON_MENTION_PATTERN = re.compile(r'(@\w+)@[\w.-]+\.\w+')
+TWITTER_LIGHT_RANGES = ((0, 4351), (8192, 8205), (8208, 8223), (8242, 8247))
+EMOJI_PATTERN = unicode_regex.compile(r'\p{Extended_Pictographic}|\p{Regional_Indicator}')
+
+def twitter_weight(grapheme):
+    if EMOJI_PATTERN.search(grapheme):
+        return 2
+    return sum(1 if any(low <= ord(ch) <= high for low, high in TWITTER_LIGHT_RANGES) else 2 for ch in grapheme)
+
+def twitter_length(line):
+    line = unicodedata.normalize("NFC", line)
+    urls = URL_PATTERN.findall(line)
+    text = URL_PATTERN.sub("", line)
+    return len(urls) * URL_LENGTH + sum(twitter_weight(g) for g in unicode_regex.findall(r'\X', text))
+
+def mastodon_length(line):
+    line = MASTODON_MENTION_PATTERN.sub(r'\1', line)
+    return len(unicode_regex.findall(r'\X', URL_PATTERN.sub("x" * URL_LENGTH, line)))
+
+def bluesky_length(line):
+    return len(unicode_regex.findall(r'\X', line))
+
+@functools.lru_cache(maxsize=4096)
+def line_length(network, line):
+    platform = PLATFORMS.get(network)
+    return (platform.count_length if platform else len)(line)
 
-CHAR_LIMITS = {"twitter": 280, "mastodon": 500, "bluesky": 300}
+def post_length(network, content):
+    lines = content.split("\n")
+    return sum(line_length(network, line) for line in lines) + len(lines) - 1
 
 @rt("/check_length")
-def get(content: str, account_id: list[str] = None):
+def get(content: str, account_id: list[str] = None, group_id: list[str] = None):
     if not content.strip():
         return ""
-    if not account_id:
-        active_accounts = list(accounts())
-        if not active_accounts:
+    if not account_id and not group_id:
+        selected = [account.network for account in get_accounts()]
+        if not selected:
             return "Warning: No accounts connected to check length against."
     else:
-        active_accounts = [accounts[int(id)] for id in account_id if id.isdigit() and int(id) in accounts]
-        if not active_accounts:
+        selected = [account.network for account in selected_accounts(account_id, group_id)]
+        if not selected:
             return "Warning: No valid accounts selected to check length against."
-    selected_networks = [account.network for account in active_accounts if account.network in CHAR_LIMITS]
-    if not selected_networks:
+    remaining = {network: PLATFORMS[network].char_limit - post_length(network, content) for network in sorted(set(selected)) if network in PLATFORMS}
+    if not remaining:
         return ""
-    max_len = min(CHAR_LIMITS[network] for network in selected_networks)
-    if len(content) > max_len:
-        return f"Warning: Your message ({len(content)} characters) exceeds the {max_len}-character limit for selected networks."
-    return ""
+    over = [network for network, left in remaining.items() if left < 0]
+    counts = P(" · ".join(f"{network.capitalize()}: {left} left" for network, left in remaining.items()), cls="text-muted")
+    if over:
+        names = ", ".join(network.capitalize() for network in over)
+        return counts, P(f"Warning: Your message exceeds the character limit for {names}.")
+    return counts
 
 # Login handlers (unchanged)
 @rt("/login/bluesky")
 def post(handle: str, password: str):
+    from atproto import Client as AtprotoClient
     try:
         client = AtprotoClient()
         profile = client.login(handle, password)
         credentials = {"handle": handle, "password": password}
-        accounts.insert(Account(network="bluesky", username=handle, credentials=json.dumps(credentials), created_at=datetime.now().isoformat(), updated_at=datetime.now().isoformat()))
+        account = save_account("bluesky", handle, credentials, client.export_session_string())
+        # Warming resumes the saved session in a client that tracks the account's rate limits
+        bluesky_clients.pop(account.id, None)
+        warm_up([account])
         return render_updated_accounts_tab()
     except Exception as e:
         return render_updated_accounts_tab_with_error(f"Error connecting to Bluesky: {str(e)}")
 
 @rt("/login/twitter")
 def post():
+    from selenium import webdriver
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support.ui import WebDriverWait
+    from selenium.webdriver.support import expected_conditions as EC
     try:
         driver = webdriver.Chrome()
         driver.get("https://twitter.com/i/flow/login")
@@ -379,32 +851,72 @@ def post():
         cookies = driver.get_cookies()
         try:
             driver.get("https://twitter.com/home")
-            time.sleep(2)
             profile_button = WebDriverWait(driver, 10).until(EC.element_to_be_clickable((By.CSS_SELECTOR, "[data-testid='AppTabBar_Profile_Link']")))
             profile_button.click()
-            time.sleep(2)
+            WebDriverWait(driver, 10).until(lambda d: not d.current_url.rstrip("/").endswith("/home"))
             username = driver.current_url.split("/")[-1]
         except:
             username = "twitter_user"
         driver.quit()
-        accounts.insert(Account(network="twitter", username=username, credentials=json.dumps({"cookies": cookies}), created_at=datetime.now().isoformat(), updated_at=datetime.now().isoformat()))
+        # Warming starts the headless browser this account will post with
+        warm_up([save_account("twitter", username, {"cookies": cookies})])
         return render_updated_accounts_tab()
     except Exception as e:
         return render_updated_accounts_tab_with_error(f"Error connecting to Twitter: {str(e)}")
 
-@rt("/login/mastodon")
-def post(instance: str, sess):
+@rt("/login/twitter/api")
+def post(sess):
+    verifier = secrets.token_urlsafe(64)
+    sess["twitter_code_verifier"] = verifier
+    sess["twitter_state"] = secrets.token_urlsafe(16)
+    challenge = base64.urlsafe_b64encode(hashlib.sha256(verifier.encode()).digest()).rstrip(b"=").decode()
+    auth_url = qp(TWITTER_AUTHORIZE_URL, response_type="code", client_id=TWITTER_CLIENT_ID, redirect_uri=TWITTER_REDIRECT_URI, scope=TWITTER_SCOPES,
+                  state=sess["twitter_state"], code_challenge=challenge, code_challenge_method="S256")
+    return RedirectResponse(auth_url, status_code=303)
+
+@rt("/login/twitter/callback")
+def get(code: str, state: str, sess):
     try:
-        sess["mastodon_instance"] = instance
-        app_url = f"https://{instance}/api/v1/apps"
+        if state != sess.get("twitter_state"):
+            raise Exception("The login response doesn't match the login that was started")
+        credentials = twitter_token_request(TWITTER_API_BASE, {"grant_type": "authorization_code", "code": code, "redirect_uri": TWITTER_REDIRECT_URI, "code_verifier": sess.get("twitter_code_verifier")})
+        user_response = http_client(TWITTER_API_BASE).get("/2/users/me", headers={"Authorization": f"Bearer {credentials['access_token']}"})
+        if user_response.status_code != 200:
+            raise Exception(f"Failed to look up the account: {user_response.text}")
+        username = user_response.json()["data"]["username"]
+        warm_up([save_account("twitter", username, credentials)])
+        return RedirectResponse("/", status_code=303)
+    except Exception as e:
+        return Titled("Error", Container(H1("Twitter Login Error"), P(f"Failed to authenticate: {str(e)}"), A("Return to Home", href="/"), cls="p-6"))
+
+# The app registered with a Mastodon instance is shared by every account on it
+@dataclass
+class MastodonApp:
+    instance: str = None
+    client_id: str = None
+    client_secret: str = None
+mastodon_apps = db.create(MastodonApp, pk="instance")
+
+def mastodon_app(instance):
+    app_info = mastodon_apps.get(instance, default=None)
+    if app_info is None:
         app_data = {"client_name": "Open Social Poster", "redirect_uris": MASTODON_REDIRECT_URI, "scopes": "write:statuses write:media read"}
-        app_response = requests.post(app_url, data=app_data)
+        app_response = http_client(instance).post("/api/v1/apps", data=app_data)
         if app_response.status_code != 200:
             raise Exception(f"Failed to register app: {app_response.text}")
-        app_info = app_response.json()
-        sess["mastodon_client_id"] = app_info["client_id"]
-        sess["mastodon_client_secret"] = app_info["client_secret"]
-        auth_url = qp(f"https://{instance}/oauth/authorize", redirect_uri=MASTODON_REDIRECT_URI, client_id=app_info["client_id"], scope="write:statuses write:media read", response_type="code")
+        registered = app_response.json()
+        app_info = mastodon_apps.upsert(MastodonApp(instance=instance, client_id=registered["client_id"], client_secret=registered["client_secret"]))
+    return app_info
+
+@rt("/login/mastodon")
+def post(instance: str, sess):
+    try:
+        sess["mastodon_instance"] = instance
+        app_info = mastodon_app(instance)
+        sess["mastodon_client_id"] = app_info.client_id
+        sess["mastodon_client_secret"] = app_info.client_secret
+        # force_login lets another account on the same instance sign in
+        auth_url = qp(str(http_client(instance).base_url).rstrip("/") + "/oauth/authorize", redirect_uri=MASTODON_REDIRECT_URI, client_id=app_info.client_id, scope="write:statuses write:media read", response_type="code", force_login="true")
         return RedirectResponse(auth_url, status_code=303)
     except Exception as e:
         return render_updated_accounts_tab_with_error(f"Error connecting to Mastodon: {str(e)}")
@@ -421,39 +933,46 @@ def process_mastodon_code(code: str, sess):
     instance = sess.get("mastodon_instance")
     client_id = sess.get("mastodon_client_id")
     client_secret = sess.get("mastodon_client_secret")
-    token_url = f"https://{instance}/oauth/token"
+    client = http_client(instance)
     token_data = {"client_id": client_id, "client_secret": client_secret, "code": code, "redirect_uri": MASTODON_REDIRECT_URI, "grant_type": "authorization_code"}
-    token_response = requests.post(token_url, data=token_data)
+    token_response = client.post("/oauth/token", data=token_data)
     token_info = token_response.json()
     headers = {"Authorization": f"Bearer {token_info['access_token']}"}
-    user_url = f"https://{instance}/api/v1/accounts/verify_credentials"
-    user_response = requests.get(user_url, headers=headers)
+    user_response = client.get("/api/v1/accounts/verify_credentials", headers=headers)
     user_info = user_response.json()
     credentials = {"instance": instance, "access_token": token_info["access_token"]}
-    accounts.insert(Account(network="mastodon", username=f"{user_info['username']}@{instance}", credentials=json.dumps(credentials), created_at=datetime.now().isoformat(), updated_at=datetime.now().isoformat()))
+    warm_up([save_account("mastodon", f"{user_info['username']}@{instance}", credentials)])
 
 # Logout handler (unchanged)
 @rt("/logout/{id}")
 def post(id: int):
     accounts.delete(id)
+    db.execute("DELETE FROM group_member WHERE account_id = ?", [id])
+    bump_accounts_version()
+    forget_media_handles(id)
+    bluesky_clients.pop(id, None)
+    account_health.pop(id, None)
+    close_twitter_drivers(id)
     return render_updated_accounts_tab()
 
 # Helper functions for accounts tab updates (unchanged)
 def render_updated_accounts_tab():
-    active_accounts = list(accounts())
+    active_accounts = get_accounts()
     return Div(
         H2("Your Connected Accounts"),
         render_connected_accounts(active_accounts),
+        render_account_groups(active_accounts),
         H2("Connect a New Account"),
         render_connection_forms(),
         id="accounts-content"
     )
 
 def render_updated_accounts_tab_with_error(error_msg):
-    active_accounts = list(accounts())
+    active_accounts = get_accounts()
     return Div(
         H2("Your Connected Accounts"),
         render_connected_accounts(active_accounts),
+        render_account_groups(active_accounts),
         H2("Connect a New Account"),
         render_connection_forms(),
         Alert(error_msg, cls=AlertT.error),
@@ -462,210 +981,1845 @@ def render_updated_accounts_tab_with_error(error_msg):
 
 # Post handler with media
 @rt("/post")
-def post(content: str, account_id: list[str] = None):
+def post(content: str, account_id: list[str] = None, group_id: list[str] = None, scheduled_at: str = None, idempotency_key: str = None):
     if not content.strip():
         return Alert("Please enter some content to post.", cls=AlertT.error)
-    if not account_id:
+    targets = selected_accounts(account_id, group_id)
+    if not targets:
         return Alert("Please select at least one account to post to.", cls=AlertT.error)
     
-    selected_accounts = [accounts[int(id)] for id in account_id if id.isdigit() and int(id) in accounts]
     current_uploads = list(uploads())
     
-    for account in selected_accounts:
-        max_len = CHAR_LIMITS.get(account.network, 500)
-        if len(content) > max_len:
+    for account in targets:
+        max_len = char_limit(account.network)
+        length = post_length(account.network, content)
+        if length > max_len:
             return Alert(
-                f"Message too long for {account.network.capitalize()} ({len(content)} characters exceeds {max_len}-character limit).",
+                f"Message too long for {account.network.capitalize()} ({length} characters exceeds {max_len}-character limit).",
                 cls=AlertT.error
             )
     
-    results = []
-    for account in selected_accounts:
+    if scheduled_at:
         try:
-            if account.network == "bluesky":
-                result = post_to_bluesky(account, content, current_uploads)
-                success = True
-            elif account.network == "twitter":
-                result = post_to_twitter(account, content, current_uploads)
-                success = result.startswith("Posted")
-            elif account.network == "mastodon":
-                result = post_to_mastodon(account, content, current_uploads)
-                success = True
-            else:
-                result = f"Unknown network: {account.network}"
-                success = False
-            results.append((account, success, result))
-        except Exception as e:
-            results.append((account, False, str(e)))
+            scheduled_at = datetime.fromisoformat(scheduled_at).isoformat()
+        except ValueError:
+            return Alert("Please enter a valid date and time to schedule the post.", cls=AlertT.error)
     
-    # Clear uploads table after posting
-    db.execute("DELETE FROM upload")
+    job = enqueue_post(content, targets, current_uploads, scheduled_at or None, idempotency_key or None)
     
-    result_items = [
-        Alert(
-            H4(f"{account.network.capitalize()}: {account.username}"),
-            P(message if not success else "Posted successfully!"),
-            cls=AlertT.success if success else AlertT.error
-        ) for account, success, message in results
-    ]
+    # Clear uploads table after posting; the job keeps its own references to the media
+    db.execute("DELETE FROM upload")
+    # A resubmitted form carries the same key and gets this job back; the next post gets a new key
+    next_key = render_idempotency_key(hx_swap_oob="true")
+    if job.status == "scheduled":
+        return (
+            Alert(f"Scheduled for {datetime.fromisoformat(job.scheduled_at):%Y-%m-%d %H:%M}.", cls=AlertT.success),
+            render_scheduled_posts(hx_swap_oob="true"),
+            next_key
+        )
+    return render_job_status(job.id), next_key
+
+@rt("/post/{job_id}")
+def get(job_id: int):
+    return render_job_status(job_id)
+
+# While a job runs its results are streamed over SSE: each target's alert is sent again
+# whenever its status, stage or upload progress changes, and the finished results replace
+# the whole block once every target is done.
+STREAM_INTERVAL = 0.1
+STREAM_KEEPALIVE = 15
+
+@rt("/post/{job_id}/stream")
+async def get(job_id: int):
+    async def events():
+        sent = {}
+        version = None
+        last_sent = time.monotonic()
+        while True:
+            if progress_version != version:
+                version = progress_version
+                if outbox_jobs[job_id].status in ("done", "failed"):
+                    yield sse_message(render_job_status(job_id), "done")
+                    return
+                for target in outbox_targets(where="job_id = ?", where_args=[job_id], order_by="id"):
+                    message = sse_message(render_target_result(target), f"target-{target.id}")
+                    if sent.get(target.id) != message:
+                        sent[target.id] = message
+                        last_sent = time.monotonic()
+                        yield message
+            if time.monotonic() - last_sent > STREAM_KEEPALIVE:
+                # Keeps proxies from closing a quiet stream during a long upload
+                last_sent = time.monotonic()
+                yield ": keepalive\n\n"
+            await asyncio.sleep(STREAM_INTERVAL)
+    return EventStream(events())
+
+def render_target_result(target):
+    # Only targets still in progress listen for updates; a finished one doesn't change again
+    live = {"sse_swap": f"target-{target.id}", "hx_swap": "outerHTML"} if target.status not in ("posted", "failed") else {}
+    return Alert(
+        H4(f"{target.network.capitalize()}: {target.username}"),
+        P({"posted": "Posted successfully!", "failed": target.result}.get(target.status)
+          or (post_stages.get(target.account_id, "Posting...") if target.status == "running" else "Waiting...")),
+        *(render_upload_progress(target.id) if target.status == "running" else ()),
+        cls={"posted": AlertT.success, "failed": AlertT.error}.get(target.status, AlertT.info),
+        id=f"target-{target.id}",
+        **live
+    )
+
+def render_job_status(job_id):
+    job = outbox_jobs[job_id]
+    targets = outbox_targets(where="job_id = ?", where_args=[job_id], order_by="id")
+    result_items = [render_target_result(target) for target in targets]
+    if job.status not in ("done", "failed"):
+        # Listen for updates until the worker has finished every target
+        return Div(H3("Post Results"), *result_items, hx_ext="sse", sse_connect=f"/post/{job_id}/stream",
+                   sse_swap="done", hx_swap="outerHTML", cls="space-y-2")
+    retry = Button("Retry failed", hx_post=f"/post/{job_id}/retry", hx_target="#post-result", hx_swap="innerHTML", cls=ButtonT.primary) if job.status == "failed" else ""
     return Div(
         H3("Post Results"),
         *result_items,
-        Button("Clear", hx_post="/clear-results", hx_target="#post-result", hx_swap="innerHTML"),
+        DivLAligned(retry, Button("Clear", hx_post="/clear-results", hx_vals=json.dumps({"job_id": job_id}), hx_target="#post-result", hx_swap="innerHTML")),
         cls="space-y-2"
     )
 
+def render_upload_progress(target_id):
+    return [
+        P("Processing media..." if progress.status == "processing" else f"Uploading media: {100 * (progress.sent or 0) // max(progress.size or 1, 1)}%", cls=TextT.sm)
+        for progress in upload_progress(where="target_id = ?", where_args=[target_id])
+    ]
+
+@rt("/post/{job_id}/retry")
+def post(job_id: int):
+    # Only the failed targets are sent again, reusing the media they already uploaded
+    retry_failed_targets(job_id)
+    return render_job_status(job_id)
+
 @rt("/clear-results")
-def post():
+def post(job_id: int = None):
+    if job_id is not None:
+        # Clearing a partly failed post gives up on retrying it, so its media can go
+        dismiss_failed_job(job_id)
     return ""
 
-# Posting functions with media
-def post_to_bluesky(account, content, uploads):
-    credentials = json.loads(account.credentials)
-    client = AtprotoClient()
-    client.login(credentials["handle"], credentials["password"])
+# Images over a platform's media_profile limits are downscaled and recompressed to
+# JPEG, and images carrying EXIF data are re-encoded without it.
+JPEG_QUALITIES = (90, 82, 75, 65, 50)
+
+def preprocess_image(source_path, max_bytes, max_dimension):
+    """Runs in a worker process. Returns (data, content_type), or None if the original can be sent as is."""
+    from PIL import Image, ImageOps
+    with Image.open(source_path) as image:
+        if getattr(image, "is_animated", False):
+            return None
+        source_format = image.format
+        has_exif = bool(image.getexif())
+        if os.path.getsize(source_path) <= max_bytes and max(image.size) <= max_dimension and not has_exif:
+            return None
+        # Apply the EXIF orientation before the EXIF data is dropped
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+        if source_format == "PNG":
+            buffer = io.BytesIO()
+            image.save(buffer, "PNG", optimize=True)
+            if buffer.tell() <= max_bytes:
+                return buffer.getvalue(), "image/png"
+        if image.mode in ("RGBA", "LA", "P"):
+            image = image.convert("RGBA")
+            background = Image.new("RGB", image.size, "white")
+            background.paste(image, mask=image.getchannel("A"))
+            image = background
+        elif image.mode != "RGB":
+            image = image.convert("RGB")
+        while True:
+            for quality in JPEG_QUALITIES:
+                buffer = io.BytesIO()
+                image.save(buffer, "JPEG", quality=quality, optimize=True)
+                if buffer.tell() <= max_bytes:
+                    return buffer.getvalue(), "image/jpeg"
+            image = image.resize((max(1, image.width * 3 // 4), max(1, image.height * 3 // 4)), Image.LANCZOS)
+
+# Preprocessing runs in worker processes so it doesn't hold up request or posting
+# threads. Each (content hash, profile) is converted once: concurrent posts wait on
+# the same conversion and later posts read the stored variant.
+PREPROCESS_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+preprocess_executor = None
+preprocess_lock = threading.Lock()
+preprocess_inflight = {}
+
+def get_preprocess_executor():
+    global preprocess_executor
+    with preprocess_lock:
+        if preprocess_executor is None:
+            preprocess_executor = ProcessPoolExecutor(
+                max_workers=PREPROCESS_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return preprocess_executor
+
+def variant_upload(upload, variant):
+    if variant.sha256 == upload.sha256:
+        return upload
+    filename = upload.filename
+    if variant.content_type != upload.content_type:
+        filename = os.path.splitext(filename)[0] + mimetypes.guess_extension(variant.content_type)
+    return dataclasses.replace(upload, filename=filename, content_type=variant.content_type, sha256=variant.sha256, size=variant.size)
+
+def build_variant(upload, profile):
+    global preprocess_executor
+    try:
+        prepared = get_preprocess_executor().submit(preprocess_image, media_path(upload.sha256), **PLATFORMS[profile].media_profile).result()
+    except BrokenProcessPool:
+        with preprocess_lock:
+            preprocess_executor = None
+        raise
+    if prepared is None:
+        variant = MediaVariant(source_sha256=upload.sha256, profile=profile, sha256=upload.sha256, size=upload.size, content_type=upload.content_type)
+    else:
+        data, content_type = prepared
+        sha256, size = store_media(data)
+        variant = MediaVariant(source_sha256=upload.sha256, profile=profile, sha256=sha256, size=size, content_type=content_type)
+    return media_variants.upsert(variant)
+
+def prepare_media(upload, network):
+    """Return the upload as it should be sent to network, converting it if it breaks the network's limits"""
+    if network not in PLATFORMS or not PLATFORMS[network].media_profile or not upload.content_type.startswith("image/") or upload.content_type == "image/gif":
+        return upload
+    key = (upload.sha256, network)
+    with preprocess_lock:
+        future = preprocess_inflight.get(key)
+        owner = future is None
+        if owner:
+            if key in media_variants:
+                return variant_upload(upload, media_variants[key])
+            future = preprocess_inflight[key] = Future()
+    if owner:
+        try:
+            future.set_result(build_variant(upload, network))
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            with preprocess_lock:
+                preprocess_inflight.pop(key, None)
+    try:
+        return variant_upload(upload, future.result())
+    except Exception:
+        # Send the original if it can't be converted (e.g. a format Pillow can't read)
+        return upload
+
+# Each warm-up thread waits on a conversion in the process pool, so they get a pool of
+# their own the size of the process pool rather than holding dispatch threads
+variant_executor = ThreadPoolExecutor(max_workers=PREPROCESS_WORKERS, thread_name_prefix="variants")
+
+def warm_media_variants(upload):
+    """Start preparing a new upload for every connected network before it is posted"""
+    for network in {account.network for account in get_accounts()}:
+        variant_executor.submit(prepare_media, upload, network)
+
+# Thumbnails: a small JPEG preview of each stored image, or of the first frame of a video
+# when ffmpeg is installed, made once per content hash in the preprocessing worker
+# processes and kept on disk. Previews are served with a strong ETag and an immutable
+# Cache-Control, since a hash always has the same preview, so redrawing the upload list
+# costs the browser nothing once it has them.
+THUMBNAIL_SIZE = 160
+thumbnail_dir = os.path.join(db_dir, "thumbnails")
+thumbnail_lock = threading.Lock()
+thumbnail_inflight = {}  # sha256 -> Future
+thumbnail_failed = set()  # hashes that can't be previewed, shown with an icon instead
+
+def thumbnail_path(sha256):
+    return os.path.join(thumbnail_dir, sha256[:2], f"{sha256}.jpg")
+
+def make_thumbnail(source_path, target_path, content_type):
+    """Runs in a worker process. Returns False if the file can't be previewed."""
+    from PIL import Image, ImageOps
+    if content_type.startswith("video/"):
+        if not shutil.which("ffmpeg"):
+            return False
+        frame = subprocess.run(["ffmpeg", "-v", "error", "-i", source_path, "-frames:v", "1", "-f", "image2pipe", "-vcodec", "png", "-"],
+                               capture_output=True, timeout=60)
+        if frame.returncode != 0 or not frame.stdout:
+            return False
+        source = io.BytesIO(frame.stdout)
+    elif content_type.startswith("image/"):
+        source = source_path
+    else:
+        return False
+    with Image.open(source) as image:
+        # Animated images are previewed from their first frame
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE), Image.LANCZOS)
+        if image.mode in ("RGBA", "LA", "P"):
+            image = image.convert("RGBA")
+            background = Image.new("RGB", image.size, "white")
+            background.paste(image, mask=image.getchannel("A"))
+            image = background
+        elif image.mode != "RGB":
+            image = image.convert("RGB")
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(target_path), suffix=".tmp", delete=False) as f:
+            image.save(f, "JPEG", quality=80, optimize=True)
+    os.replace(f.name, target_path)
+    return True
+
+def request_thumbnail(upload):
+    """Start making the upload's preview unless it exists, is being made, or can't be made"""
+    with thumbnail_lock:
+        if upload.sha256 in thumbnail_inflight or upload.sha256 in thumbnail_failed or os.path.exists(thumbnail_path(upload.sha256)):
+            return
+        future = thumbnail_inflight[upload.sha256] = get_preprocess_executor().submit(
+            make_thumbnail, media_path(upload.sha256), thumbnail_path(upload.sha256), upload.content_type)
+    def done(future):
+        global preprocess_executor
+        with thumbnail_lock:
+            thumbnail_inflight.pop(upload.sha256, None)
+            try:
+                made = future.result()
+            except BrokenProcessPool:
+                preprocess_executor = None
+                return  # tried again on the next render
+            except Exception:
+                made = False
+            if not made:
+                thumbnail_failed.add(upload.sha256)
+    future.add_done_callback(done)
+
+def remove_thumbnail(sha256):
+    thumbnail_failed.discard(sha256)
+    try:
+        os.remove(thumbnail_path(sha256))
+    except FileNotFoundError:
+        pass
+
+def render_thumbnail(upload):
+    if os.path.exists(thumbnail_path(upload.sha256)):
+        return Img(src=f"/thumbnail/{upload.sha256}", alt=upload.filename, loading="lazy", cls="h-10 w-10 object-cover rounded")
+    request_thumbnail(upload)
+    if upload.sha256 in thumbnail_inflight:
+        # Swapped for the preview once it has been made
+        return Span(get_file_icon(upload.filename), hx_get=f"/uploads/{upload.id}/thumbnail", hx_trigger="every 1s", hx_swap="outerHTML")
+    return get_file_icon(upload.filename)
+
+@rt("/uploads/{id}/thumbnail")
+def get(id: int):
+    upload = uploads.get(id, default=None)
+    return render_thumbnail(upload) if upload else ""
+
+@rt("/thumbnail/{sha256}")
+def get(sha256: str, req):
+    path = thumbnail_path(sha256)
+    if not re.fullmatch(r"[0-9a-f]{64}", sha256) or not os.path.exists(path):
+        return Response(status_code=404)
+    headers = {"ETag": f'"{sha256}"', "Cache-Control": "public, max-age=31536000, immutable"}
+    if req.headers.get("if-none-match") in (headers["ETag"], f'W/{headers["ETag"]}'):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, media_type="image/jpeg", headers=headers)
+
+# Tracing: each stage of a post and each HTTP request to a network is timed. Timings
+# feed in-memory histograms, exported in Prometheus text format at /metrics, and a
+# rolling table of the most recent STAGE_HISTORY spans behind the Metrics tab. Spans
+# are buffered and written in batches so timing doesn't add a write per request.
+STAGE_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+STAGE_HISTORY = 5000
+STAGE_FLUSH_SIZE = 100
+
+@dataclass
+class StageTiming:
+    id: int = None
+    network: str = None
+    stage: str = None
+    account_id: int = None
+    seconds: float = None
+    ok: bool = None
+    created_at: str = None
+stage_timings = db.create(StageTiming, pk="id")
+
+class Histogram:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = [0] * (len(STAGE_BUCKETS) + 1)  # the last bucket is +Inf
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        with self.lock:
+            self.counts[bisect.bisect_left(STAGE_BUCKETS, seconds)] += 1
+            self.sum += seconds
+
+stage_histograms = defaultdict(Histogram)  # (network, stage, outcome) -> Histogram
+stage_buffer = []
+stage_buffer_lock = threading.Lock()
+
+def record_stage(network, name, seconds, ok=True, account_id=None):
+    stage_histograms[(network, name, "ok" if ok else "error")].observe(seconds)
+    with stage_buffer_lock:
+        stage_buffer.append({"network": network, "stage": name, "account_id": account_id, "seconds": seconds, "ok": ok, "created_at": datetime.now().isoformat()})
+        full = len(stage_buffer) >= STAGE_FLUSH_SIZE
+    if full:
+        flush_stage_timings()
+
+# Live progress: the stage each account is in while it posts, shown in the post results.
+# progress_version changes whenever a target's status, stage or upload progress does,
+# so result streams only render and send again when something has changed.
+STAGE_LABELS = {
+    "media_prepare": "Preparing media...",
+    "login": "Signing in...",
+    "browser_start": "Starting browser...",
+    "compose": "Opening the composer...",
+    "media_upload": "Uploading media...",
+    "media_processing": "Processing media...",
+    "publish": "Posting...",
+}
+post_stages = {}  # account id -> label of the stage it is in
+progress_counter = itertools.count(1)
+progress_version = 0
+
+def bump_progress():
+    global progress_version
+    progress_version = next(progress_counter)
+
+@contextmanager
+def stage(network, name, account_id=None):
+    if account_id is not None and name in STAGE_LABELS:
+        post_stages[account_id] = STAGE_LABELS[name]
+        bump_progress()
+    start = time.perf_counter()
+    ok = False
+    try:
+        yield
+        ok = True
+    finally:
+        record_stage(network, name, time.perf_counter() - start, ok, account_id)
+
+def flush_stage_timings():
+    with stage_buffer_lock:
+        rows, stage_buffer[:] = list(stage_buffer), []
+    if rows:
+        stage_timings.insert_all(rows)
+        db.execute("DELETE FROM stage_timing WHERE id <= (SELECT MAX(id) FROM stage_timing) - ?", [STAGE_HISTORY])
+
+atexit.register(flush_stage_timings)
+
+@rt("/metrics")
+def get():
+    lines = ["# HELP social_poster_stage_seconds Time spent in each stage of posting and in each request to a network",
+             "# TYPE social_poster_stage_seconds histogram"]
+    for (network, name, outcome), histogram in sorted(stage_histograms.items()):
+        with histogram.lock:
+            counts, total = list(histogram.counts), histogram.sum
+        labels = f'network="{network}",stage="{name}",outcome="{outcome}"'
+        for bound, count in zip((*STAGE_BUCKETS, "+Inf"), itertools.accumulate(counts)):
+            lines.append(f'social_poster_stage_seconds_bucket{{{labels},le="{bound}"}} {count}')
+        lines.append(f"social_poster_stage_seconds_sum{{{labels}}} {total}")
+        lines.append(f"social_poster_stage_seconds_count{{{labels}}} {sum(counts)}")
+    return Response("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
+def render_metrics_tab():
+    return Div(hx_get="/metrics/dashboard", hx_trigger="load, every 10s", hx_swap="innerHTML", id="metrics-content")
+
+@rt("/metrics/dashboard")
+def get():
+    flush_stage_timings()
+    spans = defaultdict(list)
+    for row in db.q("SELECT network, stage, seconds, ok FROM stage_timing ORDER BY id DESC"):
+        spans[row["network"], row["stage"]].append((row["seconds"], row["ok"]))
+    if not spans:
+        return P("No posts have been timed yet.", cls="text-muted")
+    tables = []
+    for network in sorted({network for network, _ in spans}):
+        rows = []
+        for (_, name), timings in sorted(((key, timings) for key, timings in spans.items() if key[0] == network), key=lambda item: -sum(t for t, _ in item[1])):
+            seconds = sorted(t for t, _ in timings)
+            rows.append(Tr(Td(name), Td(len(seconds)), Td(f"{statistics.median(seconds):.2f}s"), Td(f"{seconds[int(0.95 * (len(seconds) - 1))]:.2f}s"), Td(sum(not ok for _, ok in timings))))
+        tables.append(Div(H4(network.capitalize()), Table(Thead(Tr(Th("Stage"), Th("Count"), Th("Median"), Th("p95"), Th("Errors"))), Tbody(*rows)), cls="space-y-2"))
+    return Div(P(f"The last {STAGE_HISTORY} timed stages, slowest total first.", cls="text-muted"), *tables, cls="space-y-4")
+
+# Rate limiting: requests wait on a per-account, per-endpoint budget kept in step with
+# the rate-limit headers Mastodon (X-RateLimit-*), Twitter (x-rate-limit-*) and Bluesky
+# (ratelimit-*) send, so a burst uses up what the server allows and then waits for the
+# window to reset instead of drawing 429s. Transient failures retry with jittered
+# exponential backoff.
+RETRY_ATTEMPTS = 4
+RETRY_BASE_DELAY = 1
+RETRY_MAX_DELAY = 30
+RATE_LIMIT_MAX_WAIT = 120
+
+class RetryableError(Exception):
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+def parse_rate_limit_time(value):
+    """Reset headers are epoch seconds (Bluesky), ISO timestamps (Mastodon) or a delay in seconds"""
+    if value is None:
+        return None
+    try:
+        number = float(value)
+        return number if number > 1e9 else time.time() + number
+    except ValueError:
+        try:
+            return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+        except ValueError:
+            return None
+
+def rate_limit_header(headers, name):
+    return headers.get(f"x-ratelimit-{name}") or headers.get(f"x-rate-limit-{name}") or headers.get(f"ratelimit-{name}")
+
+def retry_after(headers):
+    reset_at = parse_rate_limit_time(headers.get("retry-after")) or parse_rate_limit_time(rate_limit_header(headers, "reset"))
+    return max(0, reset_at - time.time()) if reset_at else None
+
+class RateLimit:
+    """Token bucket holding the requests left in the server's current window for one account and endpoint"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.remaining = None  # unknown until a response reports it
+        self.reset_at = 0
+
+    def update(self, headers):
+        remaining = rate_limit_header(headers, "remaining")
+        reset_at = parse_rate_limit_time(rate_limit_header(headers, "reset"))
+        if remaining is None or reset_at is None:
+            return
+        with self.lock:
+            self.remaining = int(float(remaining))
+            self.reset_at = reset_at
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.time()
+                if self.remaining is None or now >= self.reset_at:
+                    # Unknown or refilled window: go ahead and learn the budget from the response
+                    self.remaining = None
+                    return
+                if self.remaining > 0:
+                    self.remaining -= 1
+                    return
+                delay = self.reset_at - now
+            if delay > RATE_LIMIT_MAX_WAIT:
+                raise Exception(f"Rate limited until {datetime.fromtimestamp(self.reset_at).strftime('%H:%M:%S')}")
+            time.sleep(delay)
+
+rate_limits = defaultdict(RateLimit)
+
+def with_retries(call, limit):
+    for attempt in range(RETRY_ATTEMPTS):
+        limit.acquire()
+        try:
+            return call()
+        except RetryableError as e:
+            if attempt == RETRY_ATTEMPTS - 1:
+                # An error from a client library is raised as it was, so callers can inspect it
+                if e.__cause__ is not None:
+                    raise e.__cause__
+                raise Exception(str(e)) from e
+            delay = e.retry_after
+            if delay is None:
+                delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+            if delay > RATE_LIMIT_MAX_WAIT:
+                raise Exception(f"Rate limited for another {int(delay)} seconds") from e
+            time.sleep(delay)
+
+def http_call(network, account_id, endpoint, send, idempotent=True):
+    """Run send() (which makes one HTTP request to network) under the account's rate limit, retrying transient failures.
+    Non-idempotent requests only retry after a 429, which the server didn't act on."""
+    limit = rate_limits[(account_id, endpoint)]
+    def attempt():
+        start = time.perf_counter()
+        try:
+            response = send()
+        except httpx.TransportError as e:
+            record_stage(network, f"http {endpoint}", time.perf_counter() - start, False, account_id)
+            if not idempotent:
+                raise
+            raise RetryableError(f"Connection error: {e}")
+        # Numeric ids are folded out of the path so each endpoint gets one series
+        request_name = f"http {response.request.method} {re.sub(r'/[0-9]+', '/:id', response.request.url.path)}"
+        record_stage(network, request_name, time.perf_counter() - start, response.status_code < 400, account_id)
+        limit.update(response.headers)
+        if response.status_code == 429 or (idempotent and response.status_code >= 500):
+            raise RetryableError(f"{response.status_code}: {response.text}", retry_after(response.headers) if response.status_code == 429 else None)
+        return response
+    return with_retries(attempt, limit)
+
+def bluesky_call(account_id, nsid, call, idempotent=True):
+    """Like http_call for atproto calls"""
+    from atproto.exceptions import RateLimitExceededError, RequestErrorBase
+    def attempt():
+        try:
+            with stage("bluesky", f"http {nsid}", account_id):
+                return call()
+        except RateLimitExceededError as e:
+            raise RetryableError(str(e), retry_after(e.response.headers)) from e
+        except RequestErrorBase as e:
+            transient = e.response is None or e.response.status_code >= 500
+            if idempotent and transient:
+                raise RetryableError(str(e)) from e
+            raise
+    return with_retries(attempt, rate_limits[(account_id, nsid)])
+
+def bluesky_request(account_id):
+    """The HTTP layer for an account's atproto client. atproto doesn't surface headers of
+    successful responses, so its httpx client is given a hook that reads the rate limits."""
+    from atproto import Request
+    def on_response(response):
+        nsid = response.request.url.path.rsplit("/", 1)[-1]
+        rate_limits[(account_id, nsid)].update(response.headers)
+    return Request(event_hooks={"response": [on_response]})
+
+# One pooled HTTP client per host (a Mastodon instance, the Twitter API), so posts reuse
+# kept-alive connections (HTTP/2 when the h2 package is installed) instead of a new TLS
+# handshake per request. A host given with a scheme (http://localhost:8001) is used as
+# the base URL as is.
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+UPLOAD_WRITE_TIMEOUT = 300
+http_clients = {}
+http_clients_lock = threading.Lock()
+media_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="media")
+
+def http_client(host):
+    with http_clients_lock:
+        client = http_clients.get(host)
+        if client is None:
+            client = http_clients[host] = httpx.Client(
+                base_url=host if "://" in host else f"https://{host}",
+                http2=HTTP2_AVAILABLE,
+                timeout=httpx.Timeout(30, write=UPLOAD_WRITE_TIMEOUT),
+                limits=httpx.Limits(max_keepalive_connections=8, keepalive_expiry=120),
+            )
+        return client
+
+def close_http_clients():
+    with http_clients_lock:
+        clients = list(http_clients.values())
+        http_clients.clear()
+    for client in clients:
+        client.close()
+
+atexit.register(close_http_clients)
+
+# Platform adapters. Each network registers how to post to it together with its
+# limits. Client libraries are imported inside the adapter's functions, so a network
+# that is never used costs nothing at startup, and a new network is a new adapter.
+@dataclass
+class Platform:
+    name: str
+    post: callable  # (account, content, uploads, delivery) -> message, raising on failure
+    connect_card: callable
+    char_limit: int
+    count_length: callable = len
+    concurrency: int = 4  # posts at once per host
+    host: callable = None  # (credentials) -> the server an account posts to, when the network has more than one
+    warm: callable = None  # (account) -> checks the account can post, opening its connections on the way
+    media_profile: dict = None
+    media_ttl: int = None  # seconds a posted media handle can be reused by the same account, None to always upload
+    media_rejected: callable = None  # (exception) -> whether the server refused a cached media handle
+    media_reuse: int = 0  # seconds an uploaded handle no post has used yet stays on the server
+
+PLATFORMS = {}
+
+@dataclass
+class Delivery:
+    """What one target has on the remote side: media uploaded so far (sha256 -> handle) and, once posted, the post's id"""
+    media: dict = dataclasses.field(default_factory=dict)
+    remote_id: str = None
+    target_id: int = None  # the outbox target, which upload progress is shown for
+    uploaded_at: dict = dataclasses.field(default_factory=dict)  # sha256 -> time.time() its handle was uploaded
+
+def register_platform(platform):
+    PLATFORMS[platform.name] = platform
+    return platform
+
+def char_limit(network):
+    return PLATFORMS[network].char_limit if network in PLATFORMS else 500
+
+# Remote media cache: handles returned for media an account has posted, keyed by the
+# account and the content hash, so attaching the same file again skips the upload.
+# Entries expire after the platform's media_ttl.
+@dataclass
+class RemoteMedia:
+    account_id: int = None
+    sha256: str = None
+    handle: str = None  # JSON
+    expires_at: str = None
+remote_media = db.create(RemoteMedia, pk=("account_id", "sha256"))
+
+def cached_media_handles(account_id, sha256s):
+    rows = db.q(f"SELECT sha256, handle FROM remote_media WHERE account_id = ? AND expires_at > ? AND sha256 IN ({','.join('?' * len(sha256s))})",
+                [account_id, datetime.now().isoformat(), *sha256s])
+    return {row["sha256"]: json.loads(row["handle"]) for row in rows}
+
+def cache_media_handles(account_id, handles, ttl):
+    now = datetime.now()
+    expires_at = (now + timedelta(seconds=ttl)).isoformat()
+    for sha256, handle in handles.items():
+        remote_media.upsert(RemoteMedia(account_id=account_id, sha256=sha256, handle=json.dumps(handle), expires_at=expires_at))
+    db.execute("DELETE FROM remote_media WHERE expires_at <= ?", [now.isoformat()])
+
+def forget_media_handles(account_id, sha256s=None):
+    if sha256s is None:
+        db.execute("DELETE FROM remote_media WHERE account_id = ?", [account_id])
+    else:
+        for sha256 in sha256s:
+            db.execute("DELETE FROM remote_media WHERE account_id = ? AND sha256 = ?", [account_id, sha256])
+
+# Upload progress: one row per upload of a stored file while it is being sent, tied to
+# the outbox target it is for, so the post results can show how far an upload has got.
+# Media is streamed from disk rather than read into memory, and a Twitter chunked upload
+# that fails part way carries on after a retry or restart from the segments the server
+# already acknowledged (Mastodon and Bluesky uploads are single requests and start again
+# from the beginning). An unfinished upload is only taken over once nothing in this
+# process is still sending it, so two uploads of one file to one account stay apart.
+PROGRESS_INTERVAL = 0.5
+TWITTER_RESUME_WINDOW = 23 * 3600  # Twitter drops unfinished media 24 hours after INIT
+
+@dataclass
+class UploadProgress:
+    id: str = None
+    target_id: int = None  # the outbox target the upload is for, if any
+    account_id: int = None
+    sha256: str = None
+    remote_id: str = None  # the platform's id for an upload that can be resumed
+    sent: int = None  # bytes sent, or acknowledged for a resumable upload
+    size: int = None
+    segments: str = None  # JSON list of acknowledged segment indexes
+    status: str = None  # uploading or processing
+    updated_at: str = None
+upload_progress = db.create(UploadProgress, name="upload_attempt", pk="id", transform=True)
+upload_progress.create_index(["account_id", "sha256"], if_not_exists=True)
+upload_progress.create_index(["target_id"], if_not_exists=True)
+live_uploads = set()  # progress ids being sent by this process
+live_uploads_lock = threading.Lock()
+
+def claim_upload_progress(account_id, sha256, target_id=None, resumable_since=None):
+    """Start tracking an upload. With resumable_since, an unfinished upload of the same file
+    that nothing is sending any more is taken over instead, and returned with its remote_id."""
+    with live_uploads_lock:
+        if resumable_since:
+            for progress in upload_progress(where="account_id = ? AND sha256 = ? AND remote_id IS NOT NULL AND status = 'uploading' AND updated_at > ?",
+                                            where_args=[account_id, sha256, resumable_since]):
+                if progress.id not in live_uploads:
+                    live_uploads.add(progress.id)
+                    return upload_progress.update({"id": progress.id, "target_id": target_id})
+        progress = upload_progress.insert(UploadProgress(id=uuid.uuid4().hex, target_id=target_id, account_id=account_id, sha256=sha256,
+                                                         sent=0, status="uploading", updated_at=datetime.now().isoformat()))
+        live_uploads.add(progress.id)
+    bump_progress()
+    return progress
+
+def save_upload_progress(progress_id, **changes):
+    try:
+        upload_progress.update({"id": progress_id, "updated_at": datetime.now().isoformat(), **changes})
+    except NotFoundError:
+        return  # progress is only for show, so an upload carries on without its row
+    bump_progress()
+
+def clean_upload_progress():
+    # Runs at server start rather than import, since preprocessing worker processes
+    # re-import this module while uploads are in flight.
+    # Rows from before progress was kept per upload can't be told apart, so those uploads start over
+    db.execute("DROP TABLE IF EXISTS upload_progress")
+    # Uploads that can't be resumed and were cut short by a shutdown have nothing worth keeping
+    db.execute("DELETE FROM upload_attempt WHERE remote_id IS NULL")
+
+def release_upload_progress(progress_id):
+    """Stop sending an upload but keep its row, so a later attempt can resume it"""
+    with live_uploads_lock:
+        live_uploads.discard(progress_id)
+    bump_progress()
+
+def clear_upload_progress(progress_id):
+    with live_uploads_lock:
+        db.execute("DELETE FROM upload_attempt WHERE id = ?", [progress_id])
+        live_uploads.discard(progress_id)
+    bump_progress()
+
+class ProgressFile:
+    """Wraps an open media file and records how much of it has been read, at most every PROGRESS_INTERVAL seconds"""
+    def __init__(self, f, progress_id):
+        self.f, self.progress_id = f, progress_id
+        self.size = os.fstat(f.fileno()).st_size
+        self.reported = 0
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        now = time.monotonic()
+        if now - self.reported > PROGRESS_INTERVAL or not data:
+            self.reported = now
+            save_upload_progress(self.progress_id, sent=self.f.tell(), size=self.size, status="uploading")
+        return data
+
+    def __iter__(self):
+        return iter(lambda: self.read(UPLOAD_CHUNK_SIZE), b"")
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.f.close()
+
+def open_media_with_progress(progress_id, upload):
+    return ProgressFile(open_media(upload), progress_id)
+
+# Concurrent dispatch: every selected account is posted to in parallel, with a cap on
+# posts at once per host (each Mastodon instance, Bluesky PDS or Twitter endpoint) so a
+# fan-out to hundreds of accounts doesn't overwhelm any one server, and a timeout per target
+POST_TIMEOUT = 300
+post_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix="post")
+host_slots = {}
+host_slots_lock = threading.Lock()
+HOST_CONCURRENCY = {("twitter", "browser"): 1}  # hosts capped below their platform's concurrency
+
+def host_slot(account):
+    platform = PLATFORMS[account.network]
+    host = platform.host(account_credentials(account)) if platform.host else None
+    with host_slots_lock:
+        if (account.network, host) not in host_slots:
+            limit = HOST_CONCURRENCY.get((account.network, host), platform.concurrency)
+            host_slots[(account.network, host)] = threading.BoundedSemaphore(limit)
+        return host_slots[(account.network, host)]
+
+def post_to_account(account, content, uploads, delivery=None):
+    platform = PLATFORMS.get(account.network)
+    if platform is None:
+        return False, f"Unknown network: {account.network}"
+    delivery = delivery or Delivery()
+    # Handles an earlier attempt uploaded are dropped by the server if no post uses them
+    # in time, so ones older than the platform's media_reuse are uploaded again
+    now = time.time()
+    for sha256 in list(delivery.media):
+        if now - delivery.uploaded_at.get(sha256, 0) > platform.media_reuse:
+            delivery.media.pop(sha256)
+            delivery.uploaded_at.pop(sha256, None)
+    reused = list(delivery.media)
+    try:
+        with stage(account.network, "total", account.id):
+            with stage(account.network, "media_prepare", account.id):
+                uploads = [prepare_media(upload, account.network) for upload in uploads]
+            cached = {}
+            if platform.media_ttl:
+                cached = {sha256: handle for sha256, handle in cached_media_handles(account.id, [upload.sha256 for upload in uploads]).items() if sha256 not in delivery.media}
+                delivery.media.update(cached)
+            try:
+                message = platform.post(account, content, uploads, delivery)
+            except Exception as e:
+                if not (cached or reused) or not (platform.media_rejected and platform.media_rejected(e)):
+                    raise
+                # The server no longer has a handle uploaded before this attempt, so upload those again
+                forget_media_handles(account.id, cached)
+                for sha256 in [*cached, *reused]:
+                    delivery.media.pop(sha256, None)
+                    delivery.uploaded_at.pop(sha256, None)
+                message = platform.post(account, content, uploads, delivery)
+            if platform.media_ttl:
+                cache_media_handles(account.id, delivery.media, platform.media_ttl)
+            return True, message
+    finally:
+        # Handles uploaded by this attempt are dated for a retry to judge their age by
+        for sha256 in list(delivery.media):
+            delivery.uploaded_at.setdefault(sha256, now)
+        post_stages.pop(account.id, None)
+        flush_stage_timings()
+
+def dispatch_posts(selected_accounts, content, uploads, timeout=POST_TIMEOUT, deliveries=None, on_result=None):
+    """Post to all accounts concurrently and return (account, success, message) in input order.
+
+    A target is only handed to a worker once its host has a free slot, so targets
+    waiting on a busy host don't hold workers that targets on other hosts could use.
+    The timeout for a target starts once it is running, so targets queued behind a
+    slow post on the same host are not penalised for waiting.
+    deliveries, one per account, carry media already uploaded for it and collect what is uploaded now.
+    on_result(index, success, message) is called as each target finishes, before the slowest is done.
+    A target that runs past the timeout is returned as timed out, but its worker can't be
+    stopped, so on_result is only called once the worker returns, with its real outcome.
+    """
+    started = {}
+    def run(index, account, slot):
+        try:
+            started[index] = time.monotonic()
+            return post_to_account(account, content, uploads, deliveries[index] if deliveries else None)
+        finally:
+            slot.release()
     
-    # Helper function to convert character index to byte offset
-    def char_to_byte_index(s, char_index):
-        return len(s[:char_index].encode('utf-8'))
+    outcomes = {}
+    def finish(index, outcome):
+        outcomes[index] = outcome
+        if on_result:
+            on_result(index, *outcome)
     
-    # Find all URLs and calculate their byte offsets
-    url_pattern = re.compile(r'https?://[^\s]+')
-    matches = list(url_pattern.finditer(content))
-    facets = []
-    for match in matches:
-        start_char = match.start()
-        end_char = match.end()
-        byte_start = char_to_byte_index(content, start_char)
-        byte_end = char_to_byte_index(content, end_char)
-        url = match.group()
-        facet = models.AppBskyRichtextFacet.Main(
-            features=[models.AppBskyRichtextFacet.Link(uri=url)],
-            index=models.AppBskyRichtextFacet.ByteSlice(byte_start=byte_start, byte_end=byte_end)
+    def outcome_of(future):
+        try:
+            return future.result()
+        except Exception as e:
+            return (False, str(e))
+    
+    queued = []
+    for index, account in enumerate(selected_accounts):
+        if account.network in PLATFORMS:
+            queued.append((index, account))
+        else:
+            finish(index, (False, f"Unknown network: {account.network}"))
+    queued_at = time.perf_counter()
+    futures = {}
+    while queued or futures:
+        waiting = []
+        for index, account in queued:
+            slot = host_slot(account)
+            if slot.acquire(blocking=False):
+                record_stage(account.network, "slot_wait", time.perf_counter() - queued_at, account_id=account.id)
+                futures[post_executor.submit(run, index, account, slot)] = index
+            else:
+                waiting.append((index, account))
+        queued = waiting
+        # Slots can be freed by other jobs too, so targets still queued are looked at again soon
+        if not futures:
+            time.sleep(0.05)
+            continue
+        done, _ = wait(futures, timeout=0.05 if queued else 1, return_when=FIRST_COMPLETED)
+        for future in done:
+            finish(futures.pop(future), outcome_of(future))
+        now = time.monotonic()
+        for future, index in list(futures.items()):
+            if index in started and now - started[index] > timeout:
+                # The worker keeps its host slot until it finishes, and may still post
+                outcomes[index] = (False, f"Timed out after {timeout} seconds")
+                if on_result:
+                    future.add_done_callback(lambda future, index=index: on_result(index, *outcome_of(future)))
+                del futures[future]
+    return [(account, *outcomes[i]) for i, account in enumerate(selected_accounts)]
+
+# Outbox: /post stores a job with one target row per account and returns straight
+# away. A background worker drains it, so posting doesn't hold the request open, and
+# jobs interrupted by a restart are picked up again on the next start.
+@dataclass
+class OutboxJob:
+    id: int = None
+    content: str = None
+    media: str = None
+    status: str = None
+    created_at: str = None
+    updated_at: str = None
+    scheduled_at: str = None
+    idempotency_key: str = None
+outbox_jobs = db.create(OutboxJob, pk="id", transform=True)
+outbox_jobs.create_index(["idempotency_key"], unique=True, if_not_exists=True)
+outbox_jobs.create_index(["status"], if_not_exists=True)
+outbox_jobs.create_index(["status", "scheduled_at"], if_not_exists=True)
+
+@dataclass
+class OutboxTarget:
+    id: int = None
+    job_id: int = None
+    account_id: int = None
+    network: str = None
+    username: str = None
+    status: str = None
+    result: str = None
+    updated_at: str = None
+    remote_id: str = None
+    remote_media: str = None  # JSON {sha256: media handle} uploaded to this target so far
+    remote_media_at: str = None  # JSON {sha256: time.time() it was uploaded}
+outbox_targets = db.create(OutboxTarget, pk="id", transform=True)
+outbox_targets.create_index(["job_id"], if_not_exists=True)
+
+OUTBOX_WORKERS = 4
+outbox_wakeup = threading.Event()
+enqueue_lock = threading.Lock()
+outbox_executor = ThreadPoolExecutor(max_workers=OUTBOX_WORKERS, thread_name_prefix="outbox")
+
+def enqueue_post(content, selected_accounts, current_uploads, scheduled_at=None, idempotency_key=None):
+    """Store a job and its targets. A job already stored under idempotency_key is returned instead of posting twice."""
+    now = datetime.now().isoformat()
+    media = [dataclasses.asdict(upload) for upload in current_uploads]
+    status = "scheduled" if scheduled_at and scheduled_at > now else "pending"
+    with enqueue_lock:
+        if idempotency_key and (existing := outbox_jobs(where="idempotency_key = ?", where_args=[idempotency_key], limit=1)):
+            return existing[0]
+        job = outbox_jobs.insert(OutboxJob(content=content, media=json.dumps(media), status=status, scheduled_at=scheduled_at, created_at=now, updated_at=now, idempotency_key=idempotency_key))
+        for account in selected_accounts:
+            outbox_targets.insert(OutboxTarget(job_id=job.id, account_id=account.id, network=account.network, username=account.username, status="pending", updated_at=now))
+    if status == "scheduled":
+        schedule_job(job)
+    else:
+        outbox_wakeup.set()
+    return job
+
+def job_uploads(job):
+    return [Upload(**upload) for upload in json.loads(job.media or "[]")]
+
+def update_target(target, status, result=None, delivery=None):
+    changes = {"id": target.id, "status": status, "result": result, "updated_at": datetime.now().isoformat()}
+    if delivery:
+        changes.update(remote_id=delivery.remote_id, remote_media=json.dumps(delivery.media), remote_media_at=json.dumps(delivery.uploaded_at))
+    outbox_targets.update(changes)
+    bump_progress()
+
+def run_outbox_job(job):
+    lock = threading.Lock()
+    dispatched = False
+    try:
+        runnable = []
+        for target in outbox_targets(where="job_id = ? AND status = 'pending'", where_args=[job.id]):
+            account = get_account(target.account_id)
+            if target.remote_id:
+                # An earlier attempt got as far as posting, so sending again would post twice
+                update_target(target, "posted")
+            elif account:
+                runnable.append((target, account))
+                update_target(target, "running")
+            else:
+                update_target(target, "failed", "Account is no longer connected")
+        # Media a previous attempt already uploaded to a target is reused rather than sent again
+        deliveries = [Delivery(media=json.loads(target.remote_media or "{}"), uploaded_at=json.loads(target.remote_media_at or "{}"), target_id=target.id)
+                      for target, _ in runnable]
+        # Each target is stored as soon as it finishes so the results stream can show it.
+        # A target that timed out stays running until its worker returns, and the job is
+        # finished from here once the last one does.
+        def on_result(index, success, message):
+            delivery = deliveries[index]
+            with lock:
+                update_target(runnable[index][0], "posted" if success or delivery.remote_id else "failed", message, delivery)
+                if dispatched:
+                    finish_outbox_job(job)
+        dispatch_posts([account for _, account in runnable], job.content, job_uploads(job), deliveries=deliveries, on_result=on_result)
+    except Exception as e:
+        db.execute("UPDATE outbox_target SET status = 'failed', result = ? WHERE job_id = ? AND status IN ('pending', 'running')", [str(e), job.id])
+    with lock:
+        dispatched = True
+        finish_outbox_job(job)
+
+def finish_outbox_job(job):
+    """Mark the job done or failed once none of its targets are still running"""
+    if db.q("SELECT 1 FROM outbox_target WHERE job_id = ? AND status = 'running' LIMIT 1", [job.id]):
+        return
+    # A job with failed targets keeps its media so "Retry failed" can send it to them later
+    failed = db.q("SELECT 1 FROM outbox_target WHERE job_id = ? AND status = 'failed' LIMIT 1", [job.id])
+    outbox_jobs.update({"id": job.id, "status": "failed" if failed else "done", "updated_at": datetime.now().isoformat()})
+    bump_progress()
+    if not failed:
+        release_media(upload.sha256 for upload in job_uploads(job))
+
+def retry_failed_targets(job_id):
+    now = datetime.now().isoformat()
+    db.execute("UPDATE outbox_target SET status = 'pending', result = NULL, updated_at = ? WHERE job_id = ? AND status = 'failed'", [now, job_id])
+    db.execute("UPDATE outbox_job SET status = 'pending', updated_at = ? WHERE id = ? AND status = 'failed'", [now, job_id])
+    outbox_wakeup.set()
+
+def dismiss_failed_job(job_id):
+    db.execute("UPDATE outbox_job SET status = 'done', updated_at = ? WHERE id = ? AND status = 'failed'", [datetime.now().isoformat(), job_id])
+    release_media(upload.sha256 for upload in job_uploads(outbox_jobs[job_id]))
+
+def outbox_worker():
+    while True:
+        outbox_wakeup.wait(timeout=60)
+        outbox_wakeup.clear()
+        for job in outbox_jobs(where="status = 'pending'", order_by="id"):
+            outbox_jobs.update({"id": job.id, "status": "running", "updated_at": datetime.now().isoformat()})
+            outbox_executor.submit(run_outbox_job, job)
+
+def start_outbox_worker():
+    # Anything still marked running was interrupted by a shutdown and runs again
+    db.execute("UPDATE outbox_target SET status = 'pending' WHERE status = 'running'")
+    db.execute("UPDATE outbox_job SET status = 'pending' WHERE status = 'running'")
+    threading.Thread(target=outbox_worker, name="outbox", daemon=True).start()
+    outbox_wakeup.set()
+
+# Scheduler: scheduled posts are outbox jobs with status "scheduled". A heap holds the
+# next SCHEDULER_BATCH due times and the scheduler sleeps until the earliest, reading
+# the next batch off the (status, scheduled_at) index, after the latest job read so far,
+# once the heap drains. Due jobs
+# become pending and the outbox workers run them, so a backlog after downtime is
+# caught up a few jobs at a time rather than all at once.
+SCHEDULER_BATCH = 100
+scheduler_heap = []
+scheduler_loaded_all = False  # every scheduled job is in the heap
+scheduler_cursor = ("", 0)  # (scheduled_at, id) of the latest job read into the heap
+scheduler_lock = threading.Lock()
+scheduler_wakeup = threading.Event()
+
+def load_scheduled_batch():
+    global scheduler_loaded_all, scheduler_cursor
+    rows = db.q("""SELECT id, scheduled_at FROM outbox_job WHERE status = 'scheduled' AND (scheduled_at, id) > (?, ?)
+                   ORDER BY scheduled_at, id LIMIT ?""", [*scheduler_cursor, SCHEDULER_BATCH])
+    for row in rows:
+        heapq.heappush(scheduler_heap, (row["scheduled_at"], row["id"]))
+    if rows:
+        scheduler_cursor = (rows[-1]["scheduled_at"], rows[-1]["id"])
+    scheduler_loaded_all = len(rows) < SCHEDULER_BATCH
+
+def schedule_job(job):
+    with scheduler_lock:
+        # Jobs after the cursor are read from the table when their turn comes
+        if scheduler_loaded_all or (job.scheduled_at, job.id) <= scheduler_cursor:
+            heapq.heappush(scheduler_heap, (job.scheduled_at, job.id))
+    scheduler_wakeup.set()
+
+def cancel_scheduled_job(job_id):
+    db.execute("UPDATE outbox_job SET status = 'cancelled', updated_at = ? WHERE id = ? AND status = 'scheduled'", [datetime.now().isoformat(), job_id])
+    release_media(upload.sha256 for upload in job_uploads(outbox_jobs[job_id]))
+
+def scheduler():
+    while True:
+        with scheduler_lock:
+            if not scheduler_heap and not scheduler_loaded_all:
+                load_scheduled_batch()
+            now = datetime.now().isoformat()
+            due = []
+            while scheduler_heap and scheduler_heap[0][0] <= now:
+                due.append(heapq.heappop(scheduler_heap)[1])
+            timeout = (datetime.fromisoformat(scheduler_heap[0][0]) - datetime.now()).total_seconds() if scheduler_heap else None
+        for job_id in due:
+            # Cancelled jobs stay in the heap and are skipped here
+            db.execute("UPDATE outbox_job SET status = 'pending', updated_at = ? WHERE id = ? AND status = 'scheduled'", [datetime.now().isoformat(), job_id])
+        if due:
+            outbox_wakeup.set()
+            continue
+        scheduler_wakeup.wait(timeout=None if timeout is None else max(0, timeout))
+        scheduler_wakeup.clear()
+
+def start_scheduler():
+    with scheduler_lock:
+        load_scheduled_batch()
+    threading.Thread(target=scheduler, name="scheduler", daemon=True).start()
+
+# Warm-up: when the server starts and whenever an account is connected, each account's
+# platform checks its credentials (refreshing tokens that need it), which also resolves
+# and connects to its host and loads the client library, so the first post doesn't pay
+# for all of that at once. The outcome is shown on the account's card.
+WARM_WORKERS = 4
+warm_executor = ThreadPoolExecutor(max_workers=WARM_WORKERS, thread_name_prefix="warm")
+account_health = {}  # account id -> (ok, message), or None while it is being checked
+
+def warm_account(account):
+    platform = PLATFORMS.get(account.network)
+    try:
+        with stage(account.network, "warm_up", account.id):
+            message = platform.warm(account) if platform and platform.warm else None
+        health = (True, message or "Connected")
+    except Exception as e:
+        health = (False, f"Couldn't connect: {e}")
+    # An account that logged out while it was being checked stays forgotten
+    if account.id in account_health:
+        account_health[account.id] = health
+
+def warm_up(accounts_to_warm):
+    for account in accounts_to_warm:
+        account_health[account.id] = None
+        warm_executor.submit(warm_account, account)
+
+def start_warm_up():
+    warm_up(get_accounts())
+
+# Background workers start with the server rather than at import, so preprocessing
+# worker processes (which re-import this module) don't start their own
+app.router.on_startup.append(clean_upload_progress)
+app.router.on_startup.append(start_outbox_worker)
+app.router.on_startup.append(start_scheduler)
+app.router.on_startup.append(start_warm_up)
+
+# Bluesky clients stay logged in per account. The exported session is stored on the
+# account whenever it is created or refreshed, so a restart resumes it instead of
+# spending one of Bluesky's rate-limited createSession calls.
+bluesky_clients = {}
+bluesky_locks = defaultdict(threading.Lock)
+
+def save_bluesky_session(account_id, event, session):
+    from atproto import SessionEvent
+    if event not in (SessionEvent.CREATE, SessionEvent.REFRESH):
+        return
+    try:
+        accounts.update({"id": account_id, "session": session.export(), "updated_at": datetime.now().isoformat()})
+        bump_accounts_version()
+    except NotFoundError:
+        pass  # account was logged out while the session refreshed
+
+def watch_bluesky_client(account_id, client):
+    client.on_session_change(lambda event, session: save_bluesky_session(account_id, event, session))
+
+def get_bluesky_client(account):
+    from atproto import Client as AtprotoClient
+    from atproto.exceptions import LoginRequiredError
+    with bluesky_locks[account.id]:
+        if account.id in bluesky_clients:
+            return bluesky_clients[account.id]
+        # "service" points an account at a PDS other than bsky.social, such as a local stand-in
+        client = AtprotoClient(base_url=account_credentials(account).get("service"), request=bluesky_request(account.id))
+        watch_bluesky_client(account.id, client)
+        with stage("bluesky", "login", account.id):
+            try:
+                # Resuming refreshes the access JWT if needed and fails if the refresh JWT has expired
+                if not account.session:
+                    raise LoginRequiredError
+                client.login(session_string=account.session)
+            except Exception:
+                credentials = account_credentials(account)
+                client.login(credentials["handle"], credentials["password"])
+        bluesky_clients[account.id] = client
+        return client
+
+def warm_bluesky(account):
+    from atproto import models  # loaded here so the first post doesn't wait for it
+    client = get_bluesky_client(account)
+    try:
+        session = bluesky_call(account.id, "com.atproto.server.getSession", lambda: client.com.atproto.server.get_session())
+    except Exception:
+        bluesky_clients.pop(account.id, None)
+        raise
+    return f"Signed in as {session.handle}"
+
+def bluesky_media_rejected(e):
+    """Whether a post was refused because a blob it references is gone from the PDS"""
+    from atproto.exceptions import RequestErrorBase
+    if not isinstance(e, RequestErrorBase) or e.response is None or e.response.status_code != 400:
+        return False
+    content = e.response.content
+    error = content.get("error") if isinstance(content, dict) else getattr(content, "error", None)
+    return error in ("BlobNotFound", "InvalidRequest")
+
+# Posting functions with media
+def post_to_bluesky(account, content, uploads, delivery=None):
+    from atproto.exceptions import UnauthorizedError, LoginRequiredError
+    try:
+        return send_bluesky_post(account, get_bluesky_client(account), content, uploads, delivery or Delivery())
+    except (UnauthorizedError, LoginRequiredError):
+        # Drop the cached session so the next post logs in again
+        bluesky_clients.pop(account.id, None)
+        raise
+
+# Rich text facets. Character offsets are mapped to UTF-8 byte offsets in a single
+# pass, and handles resolve to DIDs through a TTL cache so repeated mentions don't
+# cost a resolveHandle call each time.
+HANDLE_CACHE_TTL = 3600
+FACET_TRAILING_PUNCTUATION = ".,;:!?)]}'\""
+MENTION_PATTERN = re.compile(r'(?:^|(?<=[\s(]))@((?:[a-zA-Z0-9](?:[a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?\.)+[a-zA-Z](?:[a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?)')
+TAG_PATTERN = re.compile(r'(?:^|(?<=\s))#([^\d\s#][^\s#]*)')
+resolved_handles = {}  # handle -> (did or None, expiry)
+
+def utf8_offsets(text):
+    """Byte offset of every character index in text, plus the end, computed in one walk"""
+    return list(itertools.accumulate((1 if c < 0x80 else 2 if c < 0x800 else 3 if c < 0x10000 else 4 for c in map(ord, text)), initial=0))
+
+def resolve_handle(client, handle):
+    cached = resolved_handles.get(handle.lower())
+    if cached and cached[1] > time.monotonic():
+        return cached[0]
+    try:
+        did = client.resolve_handle(handle).did
+    except Exception:
+        did = None  # unknown handles stay plain text, and are asked about again after the TTL
+    resolved_handles[handle.lower()] = (did, time.monotonic() + HANDLE_CACHE_TTL)
+    return did
+
+def build_facets(client, content):
+    from atproto import models
+    offsets = utf8_offsets(content)
+    def facet(start, end, feature):
+        return models.AppBskyRichtextFacet.Main(
+            features=[feature],
+            index=models.AppBskyRichtextFacet.ByteSlice(byte_start=offsets[start], byte_end=offsets[end])
         )
-        facets.append(facet)
     
-    # Handle image uploads
+    facets = []
+    for match in URL_PATTERN.finditer(content):
+        url = match.group().rstrip(FACET_TRAILING_PUNCTUATION)
+        facets.append(facet(match.start(), match.start() + len(url), models.AppBskyRichtextFacet.Link(uri=url)))
+    for match in MENTION_PATTERN.finditer(content):
+        did = resolve_handle(client, match.group(1))
+        if did:
+            facets.append(facet(match.start(), match.end(), models.AppBskyRichtextFacet.Mention(did=did)))
+    for match in TAG_PATTERN.finditer(content):
+        tag = match.group(1).rstrip(FACET_TRAILING_PUNCTUATION)
+        if tag and len(tag) <= 64:
+            facets.append(facet(match.start(), match.start(1) + len(tag), models.AppBskyRichtextFacet.Tag(tag=tag)))
+    return facets
+
+def upload_bluesky_blob(account, client, upload, target_id=None):
+    # Passed as the request content, the file is streamed instead of read into memory
+    progress = claim_upload_progress(account.id, upload.sha256, target_id)
+    try:
+        with open_media_with_progress(progress.id, upload) as f:
+            return client.com.atproto.repo.upload_blob(None, content=f)
+    finally:
+        clear_upload_progress(progress.id)
+
+def send_bluesky_post(account, client, content, uploads, delivery):
+    from atproto import models
+    with stage("bluesky", "facets", account.id):
+        facets = build_facets(client, content)
+    
+    # Handle image uploads, reusing blobs this post already uploaded on an earlier attempt
     images = []
     for upload in uploads:
-        blob_response = client.upload_blob(upload.data)
-        blob_ref = blob_response.blob
+        if upload.sha256 not in delivery.media:
+            with stage("bluesky", "media_upload", account.id):
+                blob_response = bluesky_call(account.id, "com.atproto.repo.uploadBlob", lambda: upload_bluesky_blob(account, client, upload, delivery.target_id))
+            delivery.media[upload.sha256] = blob_response.blob.model_dump(mode="json", by_alias=True)
+        blob_ref = models.blob_ref.BlobRef.model_validate(delivery.media[upload.sha256])
         images.append(models.AppBskyEmbedImages.Image(alt="", image=blob_ref))
     
     embed = models.AppBskyEmbedImages.Main(images=images) if images else None
-    post = client.send_post(text=content, facets=facets if facets else None, embed=embed)
+    with stage("bluesky", "publish", account.id):
+        post = bluesky_call(account.id, "com.atproto.repo.createRecord", lambda: client.send_post(text=content, facets=facets if facets else None, embed=embed), idempotent=False)
+    delivery.remote_id = post.uri
     return f"Posted to Bluesky: {post.uri}"
 
 
-def post_to_twitter(account, content, uploads):
+register_platform(Platform(
+    name="bluesky",
+    post=post_to_bluesky,
+    connect_card=bluesky_connect_card,
+    char_limit=300,
+    count_length=bluesky_length,
+    host=lambda credentials: credentials.get("service", "bsky.social"),
+    warm=warm_bluesky,
+    media_profile={"max_bytes": 1_000_000, "max_dimension": 2000},
+    # A blob stays in the account's repo while a post references it
+    media_ttl=30 * 24 * 3600,
+    media_rejected=bluesky_media_rejected,
+    # The PDS deletes a blob no record references within minutes
+    media_reuse=5 * 60,
+))
+
+# Twitter posts reuse headless Chrome sessions that already carry the account's cookies.
+# A driver goes back to the idle pool after a post and is recycled after
+# TWITTER_DRIVER_MAX_USES posts, or straight away if the post failed or it stops responding.
+TWITTER_DRIVER_MAX_USES = 20
+TWITTER_IDLE_DRIVERS = 2
+TWITTER_UPLOAD_TIMEOUT = 120
+# /compose/tweet opens a modal over the home timeline, which has an inline composer with
+# the same test ids, so every lookup is scoped to the modal
+TWITTER_COMPOSE_TEXTAREA = "[role='dialog'] [data-testid='tweetTextarea_0']"
+TWITTER_COMPOSE_FILE_INPUT = "[role='dialog'] input[type='file']"
+TWITTER_COMPOSE_ATTACHMENTS = "[role='dialog'] [data-testid='attachments']"
+TWITTER_COMPOSE_BUTTON = "[role='dialog'] [data-testid='tweetButton']"
+twitter_drivers = defaultdict(list)  # account id -> idle [(driver, uses)]
+twitter_drivers_lock = threading.Lock()
+
+def new_twitter_driver(account):
+    from selenium import webdriver
+    credentials = account_credentials(account)
+    options = webdriver.ChromeOptions()
+    options.add_argument("--headless")
+    driver = webdriver.Chrome(options=options)
+    try:
+        driver.get("https://twitter.com")
+        for cookie in credentials.get("cookies", []):
+            driver.add_cookie({k: v for k, v in cookie.items() if k != "expiry"})
+    except Exception:
+        driver.quit()
+        raise
+    return driver
+
+def quit_twitter_driver(driver):
+    try:
+        driver.quit()
+    except Exception:
+        pass
+
+def twitter_driver_healthy(driver):
+    try:
+        return driver.execute_script("return document.readyState") is not None
+    except Exception:
+        return False
+
+@contextmanager
+def twitter_driver(account):
+    # Take one idle driver at a time, leaving the rest pooled for concurrent posts,
+    # until a healthy one turns up or the pool runs out
+    while True:
+        with twitter_drivers_lock:
+            idle = twitter_drivers[account.id]
+            driver, uses = idle.pop() if idle else (None, 0)
+        if driver is None or twitter_driver_healthy(driver):
+            break
+        quit_twitter_driver(driver)
+    if driver is None:
+        with stage("twitter", "browser_start", account.id):
+            driver = new_twitter_driver(account)
+    healthy = False
+    try:
+        yield driver
+        healthy = True
+    finally:
+        uses += 1
+        with twitter_drivers_lock:
+            # The pool entry is gone if the account logged out mid-post
+            idle = twitter_drivers.get(account.id)
+            if healthy and uses < TWITTER_DRIVER_MAX_USES and idle is not None and len(idle) < TWITTER_IDLE_DRIVERS:
+                idle.append((driver, uses))
+                driver = None
+        if driver is not None:
+            quit_twitter_driver(driver)
+
+def close_twitter_drivers(account_id=None):
+    with twitter_drivers_lock:
+        ids = [account_id] if account_id is not None else list(twitter_drivers)
+        drivers = [driver for id in ids for driver, uses in twitter_drivers.pop(id, [])]
+    for driver in drivers:
+        quit_twitter_driver(driver)
+
+atexit.register(close_twitter_drivers)
+
+def post_to_twitter(account, content, uploads, delivery=None):
     """
-    Posts a tweet with attached files using Selenium to simulate drag-and-drop behavior.
+    Posts a tweet with attached files using a pooled Selenium session to simulate drag-and-drop behavior.
     
     Args:
         account: Account object with credentials (cookies)
         content: The text content of the tweet
         uploads: List of Upload objects containing file data and metadata
+        delivery: Delivery for the target; only API accounts keep media handles in it
     
     Returns:
-        str: Success message or error description
+        str: Success message
+    
+    Raises:
+        Exception: If the tweet could not be posted
+    
+    Accounts connected through the X API post with post_to_twitter_api instead.
     """
-    # Load Twitter cookies from account credentials
-    credentials = json.loads(account.credentials)
-    cookies = credentials.get("cookies", [])
+    if "access_token" in account_credentials(account):
+        return post_to_twitter_api(account, content, uploads, delivery or Delivery())
     
-    # Set up Selenium WebDriver in headless mode
-    options = webdriver.ChromeOptions()
-    options.add_argument("--headless")
-    driver = webdriver.Chrome(options=options)
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support.ui import WebDriverWait
+    from selenium.webdriver.support import expected_conditions as EC
     
     try:
-        # Navigate to Twitter and apply cookies
-        driver.get("https://twitter.com")
-        for cookie in cookies:
-            if 'expiry' in cookie:
-                del cookie['expiry']
-            driver.add_cookie(cookie)
-        
-        # Go to the tweet compose page
-        driver.get("https://twitter.com/compose/tweet")
-        
-        # Wait for the compose page to load
-        WebDriverWait(driver, 10).until(
-            EC.presence_of_element_located((By.CSS_SELECTOR, "[data-testid='tweetTextarea_0']"))
-        )
-        
-        # Handle file uploads if any
-        if uploads:
-            # Create a temporary directory to store files
-            temp_dir = tempfile.mkdtemp()
-            file_paths = []
-            
-            # Save each uploaded file to the temporary directory
-            for upload in uploads:
-                file_path = os.path.join(temp_dir, upload.filename)
-                with open(file_path, "wb") as f:
-                    f.write(upload.data)
-                file_paths.append(file_path)
+        with twitter_driver(account) as driver:
+            # Go to the tweet compose page and wait for it to load
+            with stage("twitter", "compose", account.id):
+                driver.get("https://twitter.com/compose/tweet")
+                WebDriverWait(driver, 10).until(
+                    EC.presence_of_element_located((By.CSS_SELECTOR, TWITTER_COMPOSE_TEXTAREA))
+                )
             
-            # Locate the hidden file input element
-            file_input = driver.find_element(By.CSS_SELECTOR, "input[type='file']")
+            # Handle file uploads if any
+            if uploads:
+                # Create a temporary directory to store files
+                temp_dir = tempfile.mkdtemp()
+                try:
+                    file_paths = []
+                    
+                    # Link each stored file into the temporary directory under its original name
+                    for upload in uploads:
+                        file_path = os.path.join(temp_dir, upload.filename)
+                        link_media(upload, file_path)
+                        file_paths.append(file_path)
+                    
+                    with stage("twitter", "media_upload", account.id):
+                        # Locate the hidden file input element
+                        file_input = driver.find_element(By.CSS_SELECTOR, TWITTER_COMPOSE_FILE_INPUT)
+                        
+                        # Send the file paths to the file input element to simulate upload
+                        file_input.send_keys("\n".join(file_paths))
+                        
+                        # Wait until every attachment is shown and none is still uploading
+                        WebDriverWait(driver, TWITTER_UPLOAD_TIMEOUT).until(
+                            lambda d: d.find_elements(By.CSS_SELECTOR, TWITTER_COMPOSE_ATTACHMENTS)
+                            and not d.find_elements(By.CSS_SELECTOR, f"{TWITTER_COMPOSE_ATTACHMENTS} [role='progressbar']")
+                        )
+                finally:
+                    # Clean up temporary files
+                    shutil.rmtree(temp_dir)
             
-            # Send the file paths to the file input element to simulate upload
-            file_input.send_keys("\n".join(file_paths))
+            with stage("twitter", "publish", account.id):
+                # Locate the tweet text area and enter the content
+                tweet_textarea = driver.find_element(By.CSS_SELECTOR, TWITTER_COMPOSE_TEXTAREA)
+                tweet_textarea.send_keys(content)
+                
+                # Locate the "Post" button and click it once Twitter enables it
+                tweet_button = WebDriverWait(driver, TWITTER_UPLOAD_TIMEOUT).until(
+                    lambda d: next((button for button in d.find_elements(By.CSS_SELECTOR, TWITTER_COMPOSE_BUTTON)
+                                    if button.is_enabled() and button.get_attribute("aria-disabled") != "true"), False)
+                )
+                tweet_button.click()
+                
+                # The compose dialog closes once the tweet has been sent
+                WebDriverWait(driver, 30).until(
+                    EC.invisibility_of_element_located((By.CSS_SELECTOR, TWITTER_COMPOSE_BUTTON))
+                )
             
-            # Wait for Twitter to process the file uploads
-            time.sleep(5)  # Adjust this delay based on file size and network speed
-            
-            # Clean up temporary files
-            shutil.rmtree(temp_dir)
-        
-        # Locate the tweet text area and enter the content
-        tweet_textarea = driver.find_element(By.CSS_SELECTOR, "[data-testid='tweetTextarea_0']")
-        tweet_textarea.send_keys(content)
-        
-        # Locate and click the "Post" button
-        tweet_button = WebDriverWait(driver, 5).until(
-            EC.element_to_be_clickable((By.XPATH, "//span[text()='Post']/ancestor::button"))
-        )
-        tweet_button.click()
-        
-        # Wait for the tweet to post
-        time.sleep(5)
-        
-        return "Posted successfully!"
+            return "Posted successfully!"
     
     except Exception as e:
-        return f"Error posting to Twitter: {str(e)}"
+        raise Exception(f"Error posting to Twitter: {str(e)}") from e
+
+# Twitter API accounts post with two HTTP calls plus the media upload. Media goes
+# through the chunked INIT / APPEND / FINALIZE upload, with the APPEND segments sent in
+# parallel, and video is polled with STATUS until Twitter has processed it.
+TWITTER_SEGMENT_SIZE = 4 * 1024 * 1024
+twitter_token_locks = defaultdict(threading.Lock)
+segment_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="segment")
+
+def twitter_token_request(api_base, data):
+    auth = (TWITTER_CLIENT_ID, TWITTER_CLIENT_SECRET) if TWITTER_CLIENT_SECRET else None
+    response = http_client(api_base).post("/2/oauth2/token", data={**data, "client_id": TWITTER_CLIENT_ID}, auth=auth)
+    if response.status_code != 200:
+        raise Exception(f"Failed to get a Twitter token: {response.text}")
+    token_info = response.json()
+    return {"api_base": api_base, "access_token": token_info["access_token"], "refresh_token": token_info.get("refresh_token"),
+            "expires_at": time.time() + token_info.get("expires_in", 7200)}
+
+def twitter_access_token(account, refresh=False):
+    with twitter_token_locks[account.id]:
+        # Re-read the account, another post may have refreshed the token already
+        credentials = dict(account_credentials(get_account(account.id) or account))
+        if not refresh and credentials.get("expires_at", 0) > time.time() + 60:
+            return credentials["access_token"]
+        # Refresh tokens are single use, so the new one is saved straight away
+        credentials.update(twitter_token_request(credentials["api_base"], {"grant_type": "refresh_token", "refresh_token": credentials["refresh_token"]}))
+        accounts.update({"id": account.id, "credentials": json.dumps(credentials), "updated_at": datetime.now().isoformat()})
+        bump_accounts_version()
+        return credentials["access_token"]
+
+def twitter_api(account, endpoint, method, path, idempotent=True, **kwargs):
+    client = http_client(account_credentials(account)["api_base"])
+    def send():
+        return client.request(method, path, headers={"Authorization": f"Bearer {twitter_access_token(account)}"}, **kwargs)
+    response = http_call("twitter", account.id, endpoint, send, idempotent)
+    if response.status_code == 401:
+        twitter_access_token(account, refresh=True)
+        response = http_call("twitter", account.id, endpoint, send, idempotent)
+    return response
+
+def twitter_media_data(response, action):
+    if response.status_code not in (200, 201, 202, 204):
+        raise Exception(f"Failed to {action} media: {response.text}")
+    body = response.json() if response.content else {}
+    return body.get("data", body)
+
+def upload_twitter_media(account, upload, target_id=None):
+    size = os.path.getsize(media_path(upload.sha256))
+    resumable_since = datetime.fromtimestamp(time.time() - TWITTER_RESUME_WINDOW).isoformat()
+    progress = claim_upload_progress(account.id, upload.sha256, target_id, resumable_since)
+    try:
+        return send_twitter_media(account, upload, size, progress)
+    except Exception:
+        # Only an upload that got an id from Twitter and failed part way can be resumed
+        current = upload_progress.get(progress.id, default=None)
+        if current and (current.remote_id is None or current.status != "uploading"):
+            clear_upload_progress(progress.id)
+        raise
+    finally:
+        release_upload_progress(progress.id)
+
+def send_twitter_media(account, upload, size, progress):
+    resumed = progress.remote_id is not None
+    if resumed:
+        media_id, acknowledged = progress.remote_id, set(json.loads(progress.segments or "[]"))
+    else:
+        category = "tweet_video" if upload.content_type.startswith("video/") else "tweet_gif" if upload.content_type == "image/gif" else "tweet_image"
+        init = twitter_media_data(twitter_api(account, "media", "POST", "/2/media/upload", data={"command": "INIT", "media_type": upload.content_type, "total_bytes": size, "media_category": category}), "start uploading")
+        media_id, acknowledged = str(init.get("id") or init.get("media_id_string")), set()
+        save_upload_progress(progress.id, remote_id=media_id, sent=0, size=size, segments="[]")
     
+    # Segments are read from disk one at a time and recorded as each is acknowledged
+    progress_lock = threading.Lock()
+    def append(index):
+        if index in acknowledged:
+            return
+        with open_media(upload) as f:
+            f.seek(index * TWITTER_SEGMENT_SIZE)
+            segment = f.read(TWITTER_SEGMENT_SIZE)
+        twitter_media_data(twitter_api(account, "media", "POST", "/2/media/upload", data={"command": "APPEND", "media_id": media_id, "segment_index": index}, files={"media": segment}), "upload")
+        with progress_lock:
+            acknowledged.add(index)
+            sent = sum(min(TWITTER_SEGMENT_SIZE, size - i * TWITTER_SEGMENT_SIZE) for i in acknowledged)
+            save_upload_progress(progress.id, sent=sent, size=size, segments=json.dumps(sorted(acknowledged)))
+    try:
+        list(segment_executor.map(append, range(max(1, -(-size // TWITTER_SEGMENT_SIZE)))))
+    except Exception:
+        if resumed:
+            # Twitter may have dropped the unfinished upload, so the next attempt starts over
+            clear_upload_progress(progress.id)
+        raise
+    
+    save_upload_progress(progress.id, sent=size, size=size, status="processing")
+    info = twitter_media_data(twitter_api(account, "media", "POST", "/2/media/upload", data={"command": "FINALIZE", "media_id": media_id}), "finish uploading").get("processing_info")
+    deadline = time.monotonic() + TWITTER_UPLOAD_TIMEOUT
+    with stage("twitter", "media_processing", account.id):
+        while info and info.get("state") in ("pending", "in_progress"):
+            if time.monotonic() > deadline:
+                raise Exception("Timed out waiting for Twitter to process media")
+            time.sleep(info.get("check_after_secs", 1))
+            info = twitter_media_data(twitter_api(account, "api", "GET", "/2/media/upload", params={"command": "STATUS", "media_id": media_id}), "process").get("processing_info")
+    clear_upload_progress(progress.id)
+    if info and info.get("state") == "failed":
+        raise Exception(f"Twitter couldn't process media: {info.get('error', {}).get('message', 'unknown error')}")
+    return media_id
+
+def warm_twitter(account):
+    if "access_token" not in account_credentials(account):
+        with twitter_driver(account):
+            return "Browser ready"
+    response = twitter_api(account, "users", "GET", "/2/users/me")
+    if response.status_code != 200:
+        raise Exception(response.text)
+    return f"Signed in as @{response.json()['data']['username']}"
+
+def post_to_twitter_api(account, content, uploads, delivery):
+    # Media ids that were uploaded but never attached are reused, like on Mastodon
+    def upload_media(upload):
+        if upload.sha256 not in delivery.media:
+            with stage("twitter", "media_upload", account.id):
+                delivery.media[upload.sha256] = upload_twitter_media(account, upload, delivery.target_id)
+        return delivery.media[upload.sha256]
+    media_ids = list(media_executor.map(upload_media, uploads))
+    
+    tweet = {"text": content}
+    if media_ids:
+        tweet["media"] = {"media_ids": media_ids}
+    with stage("twitter", "publish", account.id):
+        response = twitter_api(account, "tweets", "POST", "/2/tweets", idempotent=False, json=tweet)
+    if response.status_code not in (200, 201):
+        raise Exception(f"Error posting to Twitter: {response.text}")
+    delivery.remote_id = response.json()["data"]["id"]
+    return f"Posted to Twitter: https://x.com/{account.username}/status/{delivery.remote_id}"
+
+register_platform(Platform(
+    name="twitter",
+    post=post_to_twitter,
+    connect_card=twitter_connect_card,
+    char_limit=280,
+    count_length=twitter_length,
+    # Browser accounts share one headless Chrome at a time; API accounts are capped per API host
+    host=lambda credentials: credentials["api_base"] if "access_token" in credentials else "browser",
+    warm=warm_twitter,
+    media_profile={"max_bytes": 5 * 1024 * 1024, "max_dimension": 4096},
+    media_reuse=TWITTER_RESUME_WINDOW,
+))
+
+# Mastodon media can take a while to process after upload
+MASTODON_MEDIA_TIMEOUT = 300
+
+def upload_mastodon_media(account_id, client, headers, upload, target_id=None):
+    # v2 answers 202 while large files are still processing instead of blocking the upload
+    progress = claim_upload_progress(account_id, upload.sha256, target_id)
+    def send(path):
+        with open_media_with_progress(progress.id, upload) as f:
+            return client.post(path, headers=headers, files={"file": (upload.filename, f, upload.content_type)})
+    try:
+        response = http_call("mastodon", account_id, "media", lambda: send("/api/v2/media"))
+        if response.status_code == 404:
+            response = http_call("mastodon", account_id, "media", lambda: send("/api/v1/media"))
+        if response.status_code not in (200, 202):
+            raise Exception(f"Failed to upload media: {response.text}")
+        media_id = response.json()["id"]
+        if response.status_code == 202:
+            save_upload_progress(progress.id, sent=upload.size, size=upload.size, status="processing")
+            with stage("mastodon", "media_processing", account_id):
+                wait_for_mastodon_media(account_id, client, headers, media_id)
+        return media_id
     finally:
-        driver.quit()
+        # A Mastodon upload can't be resumed, so there is nothing to keep after a failure
+        clear_upload_progress(progress.id)
+
+def wait_for_mastodon_media(account_id, client, headers, media_id):
+    deadline = time.monotonic() + MASTODON_MEDIA_TIMEOUT
+    delay = 0.5
+    while True:
+        time.sleep(delay)
+        response = http_call("mastodon", account_id, "api", lambda: client.get(f"/api/v1/media/{media_id}", headers=headers))
+        if response.status_code == 200:
+            return
+        if response.status_code != 206:
+            raise Exception(f"Failed to process media: {response.text}")
+        if time.monotonic() + delay > deadline:
+            raise Exception("Timed out waiting for Mastodon to process media")
+        delay = min(delay * 2, 5)
 
-def post_to_mastodon(account, content, uploads):
-    credentials = json.loads(account.credentials)
+def post_to_mastodon(account, content, uploads, delivery=None):
+    credentials = account_credentials(account)
+    client = http_client(credentials["instance"])
     headers = {"Authorization": f"Bearer {credentials['access_token']}"}
     
-    media_ids = []
-    for upload in uploads:
-        media_response = requests.post(
-            f"https://{credentials['instance']}/api/v1/media",
-            headers=headers,
-            files={"file": (upload.filename, upload.data, upload.content_type)}
-        )
-        if media_response.status_code != 200:
-            raise Exception(f"Failed to upload media: {media_response.text}")
-        media_ids.append(media_response.json()["id"])
+    delivery = delivery or Delivery()
+    
+    # Attachments upload in parallel; map keeps them in the order they were attached.
+    # Media uploaded by an earlier attempt was never attached to a status, so it can be reused.
+    def upload_media(upload):
+        if upload.sha256 not in delivery.media:
+            with stage("mastodon", "media_upload", account.id):
+                delivery.media[upload.sha256] = upload_mastodon_media(account.id, client, headers, upload, delivery.target_id)
+        return delivery.media[upload.sha256]
+    media_ids = list(media_executor.map(upload_media, uploads))
     
     data = {"status": content, "visibility": "public"}
     if media_ids:
         data["media_ids"] = media_ids
-    response = requests.post(
-        f"https://{credentials['instance']}/api/v1/statuses",
-        headers=headers,
-        json=data
-    )
+    # The idempotency key makes a retried request return the first status instead of posting twice
+    status_headers = {**headers, "Idempotency-Key": uuid.uuid4().hex}
+    with stage("mastodon", "publish", account.id):
+        response = http_call("mastodon", account.id, "api", lambda: client.post("/api/v1/statuses", headers=status_headers, json=data))
     if response.status_code not in (200, 201, 202):
         raise Exception(f"Failed to post: {response.text}")
-    return f"Posted to Mastodon: {response.json().get('url', 'Success!')}"
+    status = response.json()
+    delivery.remote_id = status.get("id")
+    return f"Posted to Mastodon: {status.get('url', 'Success!')}"
+
+def warm_mastodon(account):
+    credentials = account_credentials(account)
+    client = http_client(credentials["instance"])
+    response = http_call("mastodon", account.id, "api", lambda: client.get("/api/v1/accounts/verify_credentials", headers={"Authorization": f"Bearer {credentials['access_token']}"}))
+    if response.status_code != 200:
+        raise Exception(response.text)
+    return f"Signed in as @{response.json()['username']}"
+
+register_platform(Platform(
+    name="mastodon",
+    post=post_to_mastodon,
+    connect_card=mastodon_connect_card,
+    char_limit=500,
+    count_length=mastodon_length,
+    host=lambda credentials: credentials["instance"],
+    warm=warm_mastodon,
+    media_profile={"max_bytes": 16 * 1024 * 1024, "max_dimension": 3840},
+    # No media_ttl: Mastodon media can only be attached to one status, and unattached
+    # media is cleaned up after about a day
+    media_reuse=12 * 3600,
+))
+
+# Batch posting from the command line. Each row of a JSONL or CSV file is posted
+# through the same dispatch as the web UI:
+#   {"id": "launch-1", "content": "Hello", "media": ["banner.png"], "accounts": [1, "mastodon", "bluesky:me.bsky.social"]}
+# CSV files use the same column names, with media and accounts separated by ";".
+# Accounts are given by id, network, network:username or group:name. Results are appended to the
+# output file one JSON line per row, and rerunning with the same output file skips
+# every (row, account) that already posted successfully.
+def read_batch_rows(path):
+    with open(path, newline="", encoding="utf-8") as f:
+        if path.lower().endswith(".csv"):
+            for number, row in enumerate(csv.DictReader(f), 1):
+                yield {
+                    "id": row.get("id") or str(number),
+                    "content": row.get("content", ""),
+                    "media": [item for item in (row.get("media") or "").split(";") if item.strip()],
+                    "accounts": [item for item in (row.get("accounts") or "").split(";") if item.strip()],
+                }
+        else:
+            for number, line in enumerate(f, 1):
+                if line.strip():
+                    row = json.loads(line)
+                    row["id"] = str(row.get("id") or number)
+                    yield row
+
+def resolve_batch_accounts(specs):
+    selected = {}
+    groups = {group.name: group.id for group in get_groups()}
+    for spec in specs or []:
+        spec = str(spec).strip()
+        if spec.startswith("group:"):
+            for account in group_accounts(groups.get(spec[len("group:"):])):
+                selected[account.id] = account
+            continue
+        for account in get_accounts():
+            if spec in (str(account.id), account.network, f"{account.network}:{account.username}"):
+                selected[account.id] = account
+    return list(selected.values())
+
+def store_media_path(path):
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, "rb") as source, tempfile.NamedTemporaryFile(dir=media_dir, suffix=".tmp", delete=False) as f:
+        while chunk := source.read(UPLOAD_CHUNK_SIZE):
+            digest.update(chunk)
+            f.write(chunk)
+            size += len(chunk)
+    return commit_media(f.name, digest.hexdigest()), size
+
+def completed_batch_targets(output):
+    done = set()
+    if os.path.exists(output):
+        with open(output, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # a line cut short by a crash
+                done.update((record["id"], result["account_id"]) for result in record["results"] if result["success"])
+    return done
+
+def post_batch_row(row, done):
+    selected = resolve_batch_accounts(row.get("accounts"))
+    if not selected:
+        raise Exception("No connected account matches this row's accounts")
+    targets = [account for account in selected if (row["id"], account.id) not in done]
+    if not targets:
+        return None
+    results, postable = [], []
+    for account in targets:
+        length = post_length(account.network, row["content"])
+        if length > char_limit(account.network):
+            results.append((account, False, f"Message too long ({length} characters)"))
+        else:
+            postable.append(account)
+    current_uploads = []
+    for path in row.get("media") or []:
+        sha256, size = store_media_path(path)
+        content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        current_uploads.append(Upload(filename=os.path.basename(path), content_type=content_type, sha256=sha256, size=size))
+    results += dispatch_posts(postable, row["content"], current_uploads)
+    return {
+        "id": row["id"],
+        "posted_at": datetime.now().isoformat(),
+        "results": [{"account_id": account.id, "network": account.network, "username": account.username, "success": success, "message": message}
+                    for account, success, message in results],
+    }, current_uploads
+
+def run_batch(path, output, concurrency=4):
+    done = completed_batch_targets(output)
+    slots = threading.BoundedSemaphore(concurrency)
+    write_lock = threading.Lock()
+    stored = []
+    counts = {"rows": 0, "skipped": 0, "failed": 0}
+    
+    def run_row(row):
+        try:
+            try:
+                outcome = post_batch_row(row, done)
+            except Exception as e:
+                outcome = {"id": row["id"], "posted_at": datetime.now().isoformat(), "error": str(e), "results": []}, []
+            with write_lock:
+                if outcome is None:
+                    counts["skipped"] += 1
+                    return
+                record, current_uploads = outcome
+                stored.extend(upload.sha256 for upload in current_uploads)
+                counts["failed"] += sum(not result["success"] for result in record["results"]) + ("error" in record)
+                with open(output, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(record) + "\n")
+            print(f"{record['id']}: " + (record.get("error") or ", ".join(f"{r['network']}:{r['username']} {'ok' if r['success'] else r['message']}" for r in record["results"])))
+        finally:
+            slots.release()
+    
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="batch") as executor:
+        for row in read_batch_rows(path):
+            # Rows are read as earlier ones finish, so the input is never loaded whole
+            slots.acquire()
+            counts["rows"] += 1
+            executor.submit(run_row, row)
+    release_media(stored)
+    print(f"{counts['rows']} rows, {counts['skipped']} already posted, {counts['failed']} failed targets")
+    return counts["failed"] == 0
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Open Social Poster. Run without arguments to start the web UI.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    batch = commands.add_parser("batch", help="post every row of a JSONL or CSV file")
+    batch.add_argument("input", help="JSONL or CSV file of posts")
+    batch.add_argument("--output", "-o", help="results file (JSONL); reused to resume a run (default: <input>.results.jsonl)")
+    batch.add_argument("--concurrency", "-c", type=int, default=4, help="rows posted at once (default: 4)")
+    args = parser.parse_args(argv)
+    if args.command == "batch":
+        ok = run_batch(args.input, args.output or os.path.splitext(args.input)[0] + ".results.jsonl", max(1, args.concurrency))
+        sys.exit(0 if ok else 1)
 
 if __name__ == "__main__":
-    serve()
\ No newline at end of file
+    if len(sys.argv) > 1:
+        main(sys.argv[1:])
+    else:
+        serve()
\ No newline at end of file